@@ -44,5 +44,6 @@ setup(name='rcr_export_control',
       # -*- Entry points: -*-
       [console_scripts]
       rcrexport  = rcr_export_control:main
+      rcrexport-benchmark = rcr_export_control.benchmark:main
       """,
       )
@@ -1,18 +1,56 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
+from argparse import ArgumentTypeError
 from argparse import RawDescriptionHelpFormatter
+from datetime import datetime
+from rcr_export_control.htmltree import DEFAULT_HTML_ENGINE
+from rcr_export_control.htmltree import HTML_ENGINES
+from rcr_export_control.log import configure_logging
+from rcr_export_control.log import get_logger
+from rcr_export_control.log import parse_log_level
+from rcr_export_control.log import reset_after_fork
+from rcr_export_control.log import NOTICE
+from rcr_export_control.manifest import ExportManifest
+from rcr_export_control.manifest import FILES_CHANGED
+from rcr_export_control.manifest import UNCHANGED
+from rcr_export_control.manifest import check_article
+from rcr_export_control.manifest import fingerprint_export
+from rcr_export_control.manifest import make_entry
+from rcr_export_control.manifest import rebuild_archive
+from rcr_export_control.mediastore import MediaStore
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.metrics import max_rss
+from rcr_export_control.pubmed import NCBI_API_KEY_REQUEST_RATE
+from rcr_export_control.pubmed import NCBI_REQUEST_RATE
+from rcr_export_control.pubmed import PubMedCache
+from rcr_export_control.pubmed import PubMedClient
+from rcr_export_control.pubmed import RateLimiter
+from rcr_export_control.sections import parse_section_mapping
+from rcr_export_control.sections import SectionTypes
 from rcr_export_control.utils import bin_search
+from rcr_export_control.utils import ArticleConverter
+from rcr_export_control.utils import ExportSource
 from rcr_export_control.utils import execute_php_export
+from rcr_export_control.utils import list_published_articles
+from rcr_export_control.utils import stream_php_export
 from rcr_export_control.utils import create_article_archive
+from rcr_export_control.validation import get_schema
+from rcr_export_control.validation import parse_schema_path
 from subprocess import CalledProcessError
 
+import cProfile
+import functools
+import json
 import os
+import resource
 import sys
 import tempfile
+import traceback
 
 
 DESCRIPTION = """
-Produce an output zip file for each supplied article id
+Produce an output zip file for each supplied article id, or for each article
+of an issue, a volume or published since a date
 """
 EPILOG = """
 `rcrexport` creates zip archives of the required materials needed to submit an
@@ -58,92 +96,907 @@ further reduce output:
     $ rcrexport /path/to/rcr/home 793 -qqq
 
 Any increase in the number of 'q' flags beyond 3 will be ignored.
+
+Reference data for each article is looked up from PubMed.  To avoid repeating
+these lookups for references cited in many articles, a local cache of PubMed
+summaries may be kept using the '--cache' flag.  Cached summaries are reused
+for 90 days by default, which can be changed with '--cache-ttl'.  References
+linking to PubMed Central or a DOI rather than PubMed are looked up by that id,
+and the PubMed ids found are cached alongside the summaries.  A run in
+which every reference is found in the cache needs no network access:
+
+    $ rcrexport /path/to/rcr/home 793 --cache ~/.rcrexport-pubmed.sqlite
+
+Requests to PubMed are limited to 3 per second across all concurrent jobs, as
+required by NCBI.  If you have an NCBI api key, supply it with
+'--ncbi-api-key' to raise the limit to 10 requests per second.
+
+To find out which articles and which stages of conversion dominate the time
+taken by a large export, use '--profile' to record a line of JSON for each
+article with the time spent in each stage and counts of sections, figures,
+cross-references and archived bytes.  Detailed cProfile statistics for the
+conversion of each article can be written with '--profile-stats':
+
+    $ rcrexport /path/to/rcr/home 793 794 --profile metrics.jsonl \\
+        --profile-stats /tmp/stats
+
+When exporting many articles at once, the '-j' flag may be used to process
+several articles concurrently.  Each article is exported and archived in a
+separate worker process, and a summary of any failures is printed once all
+articles have been processed:
+
+    $ rcrexport /path/to/rcr/home 793 794 795 796 -j 4 -qqq
+
+When running concurrently, the verbose output of different articles will be
+interleaved, so it is best combined with the '-q' flag.
+
+To export a whole issue or volume, or every article published since a date,
+give '--issue', '--volume' or '--since' in place of article ids.  The
+published articles are listed by a single run of PHP against the RCR
+installation, and each is exported as soon as it is listed:
+
+    $ rcrexport /path/to/rcr/home --issue 5:1 -j 4 -qqq
+    $ rcrexport /path/to/rcr/home --since 2014-01-01 -j 4 -qqq
+
+Concurrent exports run in three overlapping stages: while one article is
+exported via PHP, the references of another are looked up in PubMed and a
+third is converted and archived.  The '-j' flag sets the number of articles
+converted at once, '--export-jobs' the number exported via PHP at once and
+'--lookup-jobs' the number looked up in PubMed at once.  No stage runs more
+than a few articles ahead of the next, so long lists of articles do not fill
+the disk with exports waiting to be converted:
+
+    $ rcrexport /path/to/rcr/home 793 794 795 796 -j 4 --export-jobs 2
+
+By default, PHP writes the export of each article to a temporary file which
+is read back once PHP has finished.  With '--stream', PHP writes to a pipe
+instead, and the export is converted as it is written without touching the
+disk, which helps most when temporary files live on a network file system:
+
+    $ rcrexport /path/to/rcr/home 793 794 --stream
+
+When the same articles are exported again and again, as in a nightly run over
+every published article, use '--incremental'.  A manifest kept in the output
+directory records a fingerprint of the export of each article, of the files
+copied into its archive, of the version and code of this tool and of the
+options changing its archive, like '--html-engine' and '--section-map'.  An
+article whose export has not changed is not converted again: if none of its
+files have changed either, its archive is left as it is, otherwise the files
+are copied into a new archive along with the article xml from the previous
+one:
+
+    $ rcrexport /path/to/rcr/home 793 794 795 796 --incremental
+
+Use '--force' with '--incremental' to convert and archive every article
+regardless, recording fresh fingerprints.
+
+For exports requested one at a time, as by an editorial workflow, run a local
+export service with 'rcrexport serve'.  The service keeps its workers, its
+PubMed cache and its rate limit alive between requests, so each article costs
+only its own export and conversion:
+
+    $ rcrexport serve /path/to/rcr/home -o /path/to/archives -j 2
+    $ curl -X POST localhost:8787/exports -d '{"ids": [793], "wait": true}'
+
+Run 'rcrexport serve -h' for details.
+
+A PHP process which exports articles on request, one per line, may be kept
+running with '--php-worker' instead of running importExport.php for every
+article, both by 'rcrexport' and 'rcrexport serve'.  This pays for starting
+PHP and loading the journal once for each worker rather than for every
+article.  '--export-worker' runs the export_worker.php bundled with this
+package, which exports with the same plugin importExport.php does:
+
+    $ rcrexport /path/to/rcr/home --issue 5:1 -j 4 --export-worker
+
+The html markup of each article is parsed with BeautifulSoup by default.
+'--html-engine lxml' parses it straight into lxml trees instead, which
+roughly halves the conversion time of large articles.  'rcrexport-benchmark
+--compare-engines' checks both engines give the same article xml:
+
+    $ rcrexport /path/to/rcr/home 793 794 --html-engine lxml
+
+Galley images and supplemental files are often shared by many articles, and
+deflating large ones takes most of the time spent writing archives.  With
+'--media-store', each file deflated into an archive is kept in a directory,
+keyed by a digest of its content, and later archives holding the same content
+copy the deflated data as it is.  The store is limited to 1024 megabytes by
+default, set by '--media-store-size', beyond which the files least recently
+used are dropped.  Images, videos and PDFs are not deflated at all, only
+their crc is kept so it is not computed again while they are unchanged:
+
+    $ rcrexport /path/to/rcr/home --issue 5:1 --media-store ~/.rcrexport-media
+
+Each section of an article is given a JATS section type by its heading, like
+'cases' for 'Case Report'.  Headings are compared in lower case, ignoring
+punctuation, and a heading which is not known may still match one that is
+spelled much the same, like 'Conclusion' for 'Conclusions'.  More headings
+may be given in a JSON file with '--section-map', as an object of headings
+and section types, where a section type of null leaves a heading without one:
+
+    $ echo '{"Teaching Point": "conclusions"}' > sections.json
+    $ rcrexport /path/to/rcr/home 793 --section-map sections.json
+
+Progress is logged in categories: export, sections, figures, references,
+crosslinks and archive.  Each '-q' hides one more level of detail, and
+'--log-level' sets the level of all messages or of one category, so the
+figures of an article may be followed in detail while the rest stays quiet.
+Messages go to '--log-file' if given, as JSON with '--log-json':
+
+    $ rcrexport /path/to/rcr/home 793 -qqq --log-level figures=debug \\
+        --log-file export.log --log-json
+
+To find the problems in articles without archiving them, use '--check'.  Each
+article is exported and converted as usual, but no archive is written and
+PubMed is never asked for references, which are taken from the '--cache' if
+one is given.  A line of JSON is printed for each article, listing the
+problems found, like malformed figures, references without PubMed links,
+media links to unknown files or more than one candidate galley.  Log
+messages go to stderr, so a whole journal may be swept quickly:
+
+    $ rcrexport /path/to/rcr/home --since 2010-01-01 --check -j 8 -qqq \\
+        --cache ~/.rcrexport-pubmed.sqlite > problems.jsonl
+
+PubMed Central rejects articles whose xml does not follow the JATS schema.
+To catch such articles before they are sent, give a local copy of the JATS
+DTD, XML schema or RELAX NG schema with '--validate'.  Each article is
+validated once converted, and any violations are logged as errors with the
+path of the element at fault, and listed as problems by '--check'.  The
+schema is parsed once by each worker process, as it starts:
+
+    $ rcrexport /path/to/rcr/home 793 \\
+        --validate /path/to/jats/JATS-archivearticle1.dtd
 """
 TOOL = 'tools/importExport.php'
 EXPORTER = 'JATSImportExportPlugin'
-COMMAND_LINE = "{exe} {tool} {exporter} export {tempout} rcr article {id}"
+JOURNAL = 'rcr'
+COMMAND_LINE = "{exe} {tool} {exporter} export {tempout} {journal} article {id}"
+# lists the published articles of an issue, a volume or since a date
+LIST_TOOL = os.path.join(os.path.dirname(__file__), 'list_articles.php')
+LIST_COMMAND_LINE = "{exe} {tool} {rcr_path} {journal} {selection}"
+# exports articles on request, loading RCR once, see --export-worker
+WORKER_TOOL = os.path.join(os.path.dirname(__file__), 'export_worker.php')
+WORKER_COMMAND_LINE = "{exe} {tool} {rcr_path} {exporter} {journal}"
 
 
-parser = ArgumentParser(
-    description=DESCRIPTION,
-    epilog=EPILOG,
-    formatter_class=RawDescriptionHelpFormatter)
-parser.add_argument(
+def parse_issue(value):
+    """parse an issue given as VOL:ISS into a tuple of (volume, number)"""
+    volume, sep, number = value.partition(':')
+    if not (sep and volume.isdigit() and number):
+        raise ArgumentTypeError(
+            "invalid issue {0!r}, expected VOL:ISS like 5:1".format(value)
+        )
+    return int(volume), number
+
+
+def parse_date(value):
+    """check a date given as YYYY-MM-DD"""
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ArgumentTypeError(
+            "invalid date {0!r}, expected YYYY-MM-DD".format(value)
+        )
+    return value
+
+
+# options shared by `rcrexport` and `rcrexport serve`
+options = ArgumentParser(add_help=False)
+options.add_argument(
     'rcr_path',
     metavar="/path/to/rcr",
     help="Full path to the directory where RCR is installed",
 )
-parser.add_argument(
-    'articleids', 
-    metavar="ID", 
-    type=int, 
-    nargs='+', 
-    help='Published article ID(s) separated by spaces',
-)
-parser.add_argument(
+options.add_argument(
     '-p', 
     '--php', 
     metavar="/path/to/php",
     help="Specific php executable to be used (defaults to first found in path)",
 )
-parser.add_argument(
+options.add_argument(
     '-o',
     '--output',
     metavar="/path/to/output",
     help="Specify a directory in which to write output (defaults to current"
          " working directory)",
 )
-parser.add_argument(
+options.add_argument(
     '-q',
     '--quiet',
     action='count',
     help="Decrease the verbosity of script output"
 )
+options.add_argument(
+    '-j',
+    '--jobs',
+    metavar="N",
+    type=int,
+    default=1,
+    help="Number of articles to export concurrently (defaults to 1)",
+)
+options.add_argument(
+    '--cache',
+    metavar="/path/to/cache",
+    help="Keep a persistent cache of PubMed reference summaries in this file",
+)
+options.add_argument(
+    '--cache-ttl',
+    metavar="DAYS",
+    type=float,
+    default=90,
+    help="Number of days a cached PubMed summary is reused (defaults to 90)",
+)
+options.add_argument(
+    '--cache-size',
+    metavar="MB",
+    type=int,
+    default=256,
+    help="Maximum size of the PubMed cache in megabytes (defaults to 256)",
+)
+options.add_argument(
+    '--media-store',
+    metavar="/path/to/directory",
+    help="Keep the files deflated into archives in this directory, so "
+         "archives holding the same files need not deflate them again",
+)
+options.add_argument(
+    '--media-store-size',
+    metavar="MB",
+    type=int,
+    default=1024,
+    help="Maximum size of the media store in megabytes (defaults to 1024)",
+)
+options.add_argument(
+    '--ncbi-api-key',
+    metavar="KEY",
+    help="NCBI api key used for PubMed lookups",
+)
+workers = options.add_mutually_exclusive_group()
+workers.add_argument(
+    '--php-worker',
+    metavar="COMMAND",
+    help="Command starting a persistent export worker, one for each "
+         "concurrent export. Without it, importExport.php is run for every "
+         "article",
+)
+workers.add_argument(
+    '--export-worker',
+    action='store_true',
+    help="Export articles with persistent workers running the bundled "
+         "export_worker.php, which load RCR once rather than for every "
+         "article",
+)
+options.add_argument(
+    '--html-engine',
+    choices=HTML_ENGINES,
+    default=DEFAULT_HTML_ENGINE,
+    help="Engine parsing the html of articles, 'lxml' is faster than "
+         "BeautifulSoup ('soup') on large articles (defaults to "
+         "{0})".format(DEFAULT_HTML_ENGINE),
+)
+options.add_argument(
+    '--section-map',
+    metavar="/path/to/sections.json",
+    type=parse_section_mapping,
+    help="JSON file of article headings and the JATS section types they "
+         "are given, adding to or overriding the headings known",
+)
+options.add_argument(
+    '--validate',
+    metavar="/path/to/schema",
+    type=parse_schema_path,
+    help="Validate the xml of each article against the JATS DTD, XML schema "
+         "or RELAX NG schema in this local file, logging any violations",
+)
+options.add_argument(
+    '--log-level',
+    metavar="[CATEGORY=]LEVEL",
+    type=parse_log_level,
+    action='append',
+    default=[],
+    help="Level of messages logged, for one category of messages (export, "
+         "sections, figures, references, crosslinks or archive) or for all "
+         "of them. Levels are debug, info, notice, warning and error. May "
+         "be given more than once, and overrides -q",
+)
+options.add_argument(
+    '--log-file',
+    metavar="/path/to/log",
+    help="Append log messages to this file rather than print them",
+)
+options.add_argument(
+    '--log-json',
+    action='store_true',
+    help="Log each message as a line of JSON",
+)
+options.add_argument(
+    '--profile',
+    metavar="/path/to/metrics.jsonl",
+    help="Append a JSON record of stage timings and counters for each "
+         "article to this file",
+)
+options.add_argument(
+    '--profile-stats',
+    metavar="/path/to/directory",
+    help="Write cProfile statistics for the conversion of each article to "
+         "this directory",
+)
 
 
-def main():
-    arguments = parser.parse_args()
+parser = ArgumentParser(
+    description=DESCRIPTION,
+    epilog=EPILOG,
+    formatter_class=RawDescriptionHelpFormatter,
+    parents=[options])
+parser.add_argument(
+    'articleids', 
+    metavar="ID", 
+    type=int, 
+    nargs='*', 
+    help='Published article ID(s) separated by spaces',
+)
+selections = parser.add_mutually_exclusive_group()
+selections.add_argument(
+    '--issue',
+    metavar="VOL:ISS",
+    type=parse_issue,
+    help="Export every article published in this issue, like 5:1",
+)
+selections.add_argument(
+    '--volume',
+    metavar="VOL",
+    type=int,
+    help="Export every article published in this volume",
+)
+selections.add_argument(
+    '--since',
+    metavar="YYYY-MM-DD",
+    type=parse_date,
+    help="Export every article published on or after this date",
+)
+parser.add_argument(
+    '--export-jobs',
+    metavar="N",
+    type=int,
+    help="Number of articles exported via PHP at once when running "
+         "concurrently (defaults to --jobs)",
+)
+parser.add_argument(
+    '--lookup-jobs',
+    metavar="N",
+    type=int,
+    default=2,
+    help="Number of articles whose references are looked up in PubMed at "
+         "once when running concurrently (defaults to 2)",
+)
+parser.add_argument(
+    '--stream',
+    action='store_true',
+    help="Have PHP export each article to a pipe, read as it is written, "
+         "rather than to a temporary file",
+)
+parser.add_argument(
+    '--check',
+    action='store_true',
+    help="Convert articles without archiving them or looking up references "
+         "in PubMed, printing a line of JSON listing the problems found in "
+         "each",
+)
+parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help="Skip articles unchanged since they were last archived to the output "
+         "directory",
+)
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help="With --incremental, archive every article and refresh its "
+         "fingerprints",
+)
+
+
+# the status of articles converted with --check, see `export_article`
+CHECKED = 'checked'
+
+# limits PubMed requests made by all export jobs, see `init_worker`
+_rate_limiter = None
+# processes converting articles are replaced after this many, handing the
+# memory left fragmented by their conversions back to the system
+CONVERSIONS_PER_PROCESS = 50
+
+
+def init_worker(rate_limiter, forked=False, schema_path=None):
+    """set up process-wide state shared by all export jobs
+
+    `forked` is given by pool processes, forked while threads of the parent
+    may be logging.  The schema at `schema_path`, if any, is parsed before
+    the first article is converted.
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+    if forked:
+        reset_after_fork()
+    if schema_path is not None:
+        get_schema(schema_path)
+
+
+def make_php_command(articleid, out_path, settings):
+    """return the command line exporting an article to out_path via PHP"""
+    return COMMAND_LINE.format(**{
+        'exe': settings['executable'],
+        'tool': os.path.join(settings['rcr_path'], TOOL),
+        'exporter': EXPORTER,
+        'tempout': out_path,
+        'journal': JOURNAL,
+        'id': articleid,
+    })
+
+
+def make_list_command(arguments, settings):
+    """return the command line listing the articles selected by arguments"""
+    if arguments.issue:
+        selection = 'issue {0} {1}'.format(*arguments.issue)
+    elif arguments.volume:
+        selection = 'volume {0}'.format(arguments.volume)
+    else:
+        selection = 'since {0}'.format(arguments.since)
+    return LIST_COMMAND_LINE.format(**{
+        'exe': settings['executable'],
+        'tool': LIST_TOOL,
+        'rcr_path': settings['rcr_path'],
+        'journal': JOURNAL,
+        'selection': selection,
+    })
 
+
+def make_worker_command(arguments, settings):
+    """return the command starting a persistent export worker, or None"""
+    if arguments.export_worker:
+        return WORKER_COMMAND_LINE.format(**{
+            'exe': settings['executable'],
+            'tool': WORKER_TOOL,
+            'rcr_path': settings['rcr_path'],
+            'exporter': EXPORTER,
+            'journal': JOURNAL,
+        })
+    return arguments.php_worker
+
+
+def make_pubmed_client(settings):
+    """return a PubMed client for an export job, see `init_worker`"""
+    pubmed_cache = None
+    if settings['cache_path']:
+        pubmed_cache = PubMedCache(
+            settings['cache_path'],
+            ttl=settings['cache_ttl'],
+            max_size=settings['cache_size'],
+        )
+    return PubMedClient(
+        cache=pubmed_cache,
+        rate_limiter=_rate_limiter,
+        api_key=settings['api_key'],
+        offline=settings['check'],
+    )
+
+
+def make_media_store(settings):
+    """return the store of deflated files of an export job, or None"""
+    if not settings['media_store_path']:
+        return None
+    return MediaStore(
+        settings['media_store_path'], max_size=settings['media_store_size']
+    )
+
+
+def make_section_types(settings):
+    """return the section types of headings, or None for the defaults"""
+    if not settings['section_mapping']:
+        return None
+    return SectionTypes(settings['section_mapping'])
+
+
+def make_rate_limiter(settings, shared=False):
+    """return a limiter for the PubMed requests of all export jobs"""
+    rate = NCBI_REQUEST_RATE
+    if settings['api_key']:
+        rate = NCBI_API_KEY_REQUEST_RATE
+    return RateLimiter(rate, shared=shared)
+
+
+def make_settings(arguments, php_required=True):
+    """return the settings shared by all export jobs, from parsed options"""
     # default to first found on path
     executable = arguments.php
     if not executable:
-        executable = bin_search('php')
+        if php_required:
+            executable = bin_search('php')
+        else:
+            executable = bin_search('php', None)
 
     # default to current working directory
     output_path = arguments.output
     if not output_path:
         output_path = os.getcwd()
 
-    rcr_path = arguments.rcr_path
+    return {
+        'rcr_path': arguments.rcr_path,
+        'executable': executable,
+        'output_path': output_path,
+        'cache_path': arguments.cache,
+        'cache_ttl': arguments.cache_ttl * 24 * 60 * 60,
+        'cache_size': arguments.cache_size * 1024 * 1024,
+        'media_store_path': arguments.media_store,
+        'media_store_size': arguments.media_store_size * 1024 * 1024,
+        'api_key': arguments.ncbi_api_key,
+        'profile': arguments.profile,
+        'profile_stats': arguments.profile_stats,
+        'html_engine': arguments.html_engine,
+        'section_mapping': arguments.section_map,
+        'schema_path': arguments.validate,
+        'incremental': False,
+        'stream': False,
+        'check': False,
+    }
 
-    for articleid in arguments.articleids:
-        tmp_xml_fh, tmp_xml_path = tempfile.mkstemp(suffix=".xml")
-        cl = COMMAND_LINE.format(**{
-            'exe': executable,
-            'tool': os.path.join(rcr_path, TOOL),
-            'exporter': EXPORTER,
-            'tempout': tmp_xml_path,
-            'id': articleid,
-        })
 
+def export_article(task):
+    """export a single article via PHP and build its zip archive
+
+    `task` is a tuple of (articleid, settings, previous), where settings is
+    a dict of the options shared by all articles, so that this function can
+    be mapped over a process pool.  When exporting incrementally, previous
+    is the manifest entry of the article, or None if it has none.
+
+    Returns a tuple of (articleid, error, status, entry), where error is None
+    if the article was archived successfully and a message describing the
+    failure otherwise.  When exporting incrementally, status tells whether and
+    how the article changed (see `manifest.check_article`) and entry is its
+    new manifest entry.  When checking, status is CHECKED and entry is the
+    list of problems found in the article.  Otherwise both are None.
+    """
+    articleid, settings, previous = task
+    if settings['stream']:
+        return stream_article(articleid, settings, previous)
+
+    tmp_xml_fh, tmp_xml_path = tempfile.mkstemp(suffix=".xml")
+    os.close(tmp_xml_fh)
+    cl = make_php_command(articleid, tmp_xml_path, settings)
+
+    metrics = Metrics()
+    try:
         # export article via command-line exporter
         try:
-            execute_php_export(cl, articleid)
+            with metrics.timer('php_export'):
+                execute_php_export(cl, articleid)
         except CalledProcessError, e:
-            print "Export of {0} failed due to previous errors: {1}\n".format(
-                articleid, e.output
-            )
-            sys.exit(1)
-            return
-
+            error = "export failed: {0}".format(e.output)
+            record_metrics(settings, metrics, articleid, error=error)
+            return articleid, error, None, None
         # read exported xml to build zip archive for this article
-        with open(tmp_xml_path, 'r') as fh:
-            log_level = arguments.quiet
-            create_article_archive(output_path, fh, log_level=log_level)
-
+        return convert_export((
+            articleid, ExportSource(path=tmp_xml_path), settings, metrics,
+            None, previous
+        ))
+    finally:
         # cleanup
         os.unlink(tmp_xml_path)
 
 
+def stream_article(articleid, settings, previous=None):
+    """export a single article via PHP, converting it as it is exported
+
+    returns a tuple as `export_article` does.
+    """
+    metrics = Metrics()
+    make_command = functools.partial(
+        make_php_command, articleid, settings=settings
+    )
+    try:
+        with stream_php_export(make_command, articleid) as exported:
+            return convert_export((
+                articleid, ExportSource(stream=exported), settings, metrics,
+                None, previous
+            ))
+    except CalledProcessError, e:
+        return articleid, "export failed: {0}".format(e.output), None, None
+
+
+def convert_export(task):
+    """build the zip archive of an article already exported to xml
+
+    `task` is a tuple of (articleid, source, settings, metrics, prefetched,
+    previous), where source is an `utils.ExportSource` and prefetched is
+    None or a tuple of the PubMed summaries of the article references, keyed
+    by pmid, and the PubMed build they came from.  previous is as for
+    `export_article`.  Returns a tuple as `export_article` does.
+    """
+    articleid, source, settings, metrics, prefetched, previous = task
+    pubmed_client = make_pubmed_client(settings)
+    if prefetched is not None:
+        pubmed_client.preload(*prefetched)
+
+    archive_path = None
+    error = None
+    status = None
+    entry = None
+    try:
+        if settings['check']:
+            status = CHECKED
+            entry = check_export(source, settings, pubmed_client, metrics)
+        elif settings['incremental']:
+            status, archive_path, entry = archive_incrementally(
+                articleid, source, settings, pubmed_client, metrics, previous
+            )
+        else:
+            archive_path = build_archive(
+                articleid, source, settings, pubmed_client, metrics
+            )
+    except Exception:
+        error = "archiving failed:\n{0}".format(traceback.format_exc())
+    finally:
+        pubmed_client.close()
+
+    record_metrics(
+        settings, metrics, articleid, archive_path, error, status
+    )
+    return articleid, error, status, entry
+
+
+def record_metrics(
+    settings, metrics, articleid, archive_path=None, error=None, status=None
+):
+    """append the metrics of an article to the profile, if one is kept"""
+    if settings['profile']:
+        metrics.write_record(
+            settings['profile'],
+            article=articleid,
+            archive=archive_path,
+            failed=error is not None,
+            status=status,
+        )
+
+
+def archive_incrementally(
+    articleid, source, settings, pubmed_client, metrics, previous
+):
+    """archive exported xml, doing no more than the changes since last time
+
+    `previous` is the manifest entry of the article, or None.  Returns a
+    tuple of (status, archive_path, entry), see `export_article`.
+    """
+    output_path = settings['output_path']
+    # the export is read once for its fingerprint and again to convert it
+    source.spool()
+    with metrics.timer('fingerprint'):
+        with source.open() as fh:
+            export_fingerprint = fingerprint_export(fh)
+        status = check_article(
+            previous, export_fingerprint, output_path, settings
+        )
+
+    if status == UNCHANGED:
+        return status, os.path.join(output_path, previous['archive']), previous
+
+    if status == FILES_CHANGED:
+        media_store = make_media_store(settings)
+        try:
+            with metrics.timer('archive'):
+                archive_path = rebuild_archive(
+                    previous, output_path, media_store
+                )
+        finally:
+            if media_store is not None:
+                media_store.close()
+        sources = dict(
+            (name, info['path']) for name, info in previous['files'].items()
+        )
+    else:
+        sources = {}
+        archive_path = build_archive(
+            articleid, source, settings, pubmed_client, metrics, sources
+        )
+    with metrics.timer('fingerprint'):
+        entry = make_entry(
+            export_fingerprint, archive_path, sources, previous, settings
+        )
+    return status, archive_path, entry
+
+
+def check_export(source, settings, pubmed_client, metrics):
+    """convert exported xml without archiving it, see `--check`
+
+    returns the problems found in the article.
+    """
+    converter = ArticleConverter(
+        settings['output_path'],
+        pubmed_client,
+        settings['html_engine'],
+        section_types=make_section_types(settings),
+        schema_path=settings['schema_path'],
+    )
+    with source.open() as fh:
+        return converter.check(fh, metrics)
+
+
+def build_archive(
+    articleid, source, settings, pubmed_client, metrics, sources=None
+):
+    """build the zip archive for exported xml, profiling it if requested"""
+    media_store = make_media_store(settings)
+    try:
+        with source.open() as fh:
+            args = (settings['output_path'], fh)
+            kwargs = {
+                'pubmed_client': pubmed_client,
+                'metrics': metrics,
+                'sources': sources,
+                'html_engine': settings['html_engine'],
+                'media_store': media_store,
+                'section_types': make_section_types(settings),
+                'schema_path': settings['schema_path'],
+            }
+            if not settings['profile_stats']:
+                return create_article_archive(*args, **kwargs)
+
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(
+                    create_article_archive, *args, **kwargs
+                )
+            finally:
+                profile.dump_stats(os.path.join(
+                    settings['profile_stats'], '{0}.pstats'.format(articleid)
+                ))
+    finally:
+        if media_store is not None:
+            media_store.close()
+
+
+def print_check_report(articleid, error, diagnostics):
+    """print a line of JSON with the problems found in an article"""
+    report = {
+        'article': articleid,
+        'ok': error is None and not diagnostics,
+        'diagnostics': diagnostics or [],
+    }
+    if error is not None:
+        report['error'] = error
+    print json.dumps(report, sort_keys=True)
+    sys.stdout.flush()
+
+
+def parse_arguments(args=None):
+    """parse the command line of `rcrexport`
+
+    argparse leaves article ids given after an option unparsed, now that ids
+    are optional, so they are collected here.
+    """
+    arguments, extra = parser.parse_known_args(args)
+    unknown = [arg for arg in extra if not arg.isdigit()]
+    if unknown:
+        parser.error("unrecognized arguments: {0}".format(' '.join(unknown)))
+    arguments.articleids.extend(int(arg) for arg in extra)
+    return arguments
+
+
+def main():
+    if sys.argv[1:2] == ['serve']:
+        from rcr_export_control.server import main as serve
+        return serve(sys.argv[2:])
+
+    arguments = parse_arguments()
+    listing = bool(arguments.issue or arguments.volume or arguments.since)
+    if listing == bool(arguments.articleids):
+        parser.error(
+            "give either article ids or one of --issue, --volume or --since"
+        )
+    if arguments.stream and (arguments.php_worker or arguments.export_worker):
+        parser.error(
+            "--stream cannot be used with --php-worker or --export-worker"
+        )
+    if arguments.check and arguments.incremental:
+        parser.error("--check cannot be used with --incremental")
+    settings = make_settings(
+        arguments, php_required=listing or not arguments.php_worker
+    )
+    # the reports of --check have stdout to themselves
+    configure_logging(
+        arguments.quiet, arguments.log_level, arguments.log_file,
+        arguments.log_json, sys.stderr if arguments.check else None,
+    )
+
+    settings['stream'] = arguments.stream
+    settings['check'] = arguments.check
+    manifest = None
+    if arguments.incremental:
+        manifest = ExportManifest(settings['output_path'])
+        settings['incremental'] = True
+
+    def get_previous(articleid):
+        # each task is sent only the manifest entry of its own article.
+        # With --force every article is taken to have changed.
+        if manifest is None or arguments.force:
+            return None
+        return manifest.get(articleid)
+
+    if listing:
+        # articles are exported as they are listed
+        articleids = list_published_articles(
+            make_list_command(arguments, settings)
+        )
+        jobs = max(1, arguments.jobs)
+    else:
+        articleids = arguments.articleids
+        jobs = max(1, min(arguments.jobs, len(articleids)))
+
+    php_worker = make_worker_command(arguments, settings)
+    if jobs > 1 or php_worker:
+        from rcr_export_control.exporters import make_exporters
+        from rcr_export_control.pipeline import ExportPipeline
+        export_jobs = arguments.export_jobs or jobs
+        pipeline = ExportPipeline(
+            settings,
+            convert_jobs=jobs,
+            export_jobs=export_jobs,
+            lookup_jobs=arguments.lookup_jobs,
+            exporters=make_exporters(settings, export_jobs, php_worker),
+            get_previous=get_previous,
+        )
+        results = pipeline.run(articleids)
+    else:
+        pipeline = None
+        init_worker(
+            make_rate_limiter(settings), schema_path=settings['schema_path']
+        )
+        results = (
+            export_article((articleid, settings, get_previous(articleid)))
+            for articleid in articleids
+        )
+
+    count = 0
+    failures = []
+    listing_error = None
+    try:
+        for articleid, error, status, entry in results:
+            count += 1
+            if arguments.check:
+                print_check_report(articleid, error, entry)
+                if error is not None or entry:
+                    failures.append(articleid)
+            elif error is None and status == UNCHANGED:
+                print "Article {0} unchanged, skipped\n".format(articleid)
+            elif error is None:
+                print "Article {0} archived\n".format(articleid)
+                if manifest is not None:
+                    manifest.update(articleid, entry)
+                    manifest.save_if_due()
+            else:
+                print "Article {0} failed: {1}\n".format(articleid, error)
+                failures.append(articleid)
+    except CalledProcessError, e:
+        # the listing failed, articles listed before it did were exported
+        listing_error = e.output or str(e)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        if manifest is not None:
+            manifest.save()
+
+    # pool processes converting articles have all finished by now
+    get_logger().log(
+        NOTICE, "Peak memory: %d kB, %d kB in the largest child process",
+        max_rss(), max_rss(resource.RUSAGE_CHILDREN),
+    )
+    if listing_error is not None:
+        print "Listing articles failed: {0}\n".format(listing_error)
+    if failures and not arguments.check:
+        print "{0} of {1} articles failed to export: {2}".format(
+            len(failures), count, ' '.join(map(str, sorted(failures)))
+        )
+    if failures or listing_error is not None:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     main()
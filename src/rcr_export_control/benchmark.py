@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from argparse import ArgumentTypeError
+from rcr_export_control.archiver import JATSArchiver
+from rcr_export_control.htmltree import DEFAULT_HTML_ENGINE
+from rcr_export_control.htmltree import HTML_ENGINES
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.pubmed import PubMedClient
+from rcr_export_control.pubmed import RateLimiter
+from rcr_export_control.xml_tools import parse_export_xml
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+import Queue
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+
+WORDS = (
+    "the patient presented with acute pain radiograph demonstrated a mass "
+    "lesion in right lower lobe without evidence of effusion computed "
+    "tomography showed enhancement consistent with diagnosis follow-up "
+    "imaging revealed interval resolution"
+).split()
+SECTION_HEADINGS = [
+    'Introduction', 'Case Report', 'Discussion', 'Methods', 'Results',
+    'Conclusion',
+]
+FIRST_PMID = 10000000
+# seconds between checks that a benchmark run is still alive
+RESULT_POLL_INTERVAL = 1
+
+ESUMMARY_TEMPLATE = """<?xml version="1.0"?>
+<eSummaryResult>
+<DocumentSummarySet status="OK">
+<DbBuild>Build-benchmark</DbBuild>
+{summaries}
+</DocumentSummarySet>
+</eSummaryResult>
+"""
+SUMMARY_TEMPLATE = """<DocumentSummary uid="{pmid}">
+<PubDate>2009 Jan 12</PubDate>
+<Source>Radiology</Source>
+<Authors>
+<Author><Name>Smith AB</Name></Author>
+<Author><Name>Jones C</Name></Author>
+</Authors>
+<Title>Synthetic reference {pmid}.</Title>
+<Volume>250</Volume>
+<Issue>1</Issue>
+<Pages>1-6</Pages>
+<ISSN>0033-8419</ISSN>
+<PubType><flag>journal-article</flag></PubType>
+</DocumentSummary>"""
+EMPTY_ESEARCH = """<?xml version="1.0"?>
+<eSearchResult><Count>0</Count><RetMax>0</RetMax><IdList/></eSearchResult>
+"""
+
+# the stages reported, in order
+STAGES = [
+    'parse_export',
+    'convert',
+    'exerpt_body_content',
+    'parse_html',
+    'extract_references',
+    'resolve_references',
+    'handle_references',
+    'xslt',
+    'build_section',
+    'handle_crosslinks',
+    'resolve_figures',
+    'resolve_crosslinks',
+    'archive',
+]
+
+
+def make_esummary(ids):
+    """return canned esummary xml with a summary for each pubmed id"""
+    summaries = [SUMMARY_TEMPLATE.format(pmid=pmid) for pmid in ids]
+    return ESUMMARY_TEMPLATE.format(summaries='\n'.join(summaries))
+
+
+class StubResponse(object):
+
+    ok = True
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+class StubPubMedSession(object):
+    """stands in for the requests session of a PubMedClient"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = 0
+
+    def get(self, url, params=None, **kwargs):
+        return self._respond(params)
+
+    def post(self, url, data=None, **kwargs):
+        return self._respond(data)
+
+    def close(self):
+        pass
+
+    def _respond(self, query):
+        self.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if 'term' in query:
+            # benchmark articles link references by pmid only
+            return StubResponse(EMPTY_ESEARCH)
+        return StubResponse(make_esummary(query['id'].split(',')))
+
+
+def make_stub_client(delay=0):
+    """return a PubMedClient answering from canned xml without rate limits"""
+    return PubMedClient(
+        session=StubPubMedSession(delay), rate_limiter=RateLimiter(1e9)
+    )
+
+
+def _filler(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+
+def _write_file(path, size):
+    # random content, as incompressible as the images and video it stands for
+    with open(path, 'wb') as fh:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 64 * 1024)
+            fh.write(os.urandom(block))
+            remaining -= block
+    return path
+
+
+def make_article_html(
+    sections=3,
+    paragraphs=4,
+    words=80,
+    figures=4,
+    malformed_figures=2,
+    references=20,
+    media_links=2,
+    seed=0,
+):
+    """return article html in the style of RCR article markup"""
+    rng = random.Random(seed)
+    total_figures = figures + malformed_figures
+    html = ['<p class="subheading">Abstract</p>', '<p>{0}</p>'.format(
+        _filler(rng, words)
+    )]
+    figure_number = 0
+    media_number = 0
+    for sec_index in range(sections):
+        html.append('<p class="subheading">{0}</p>'.format(
+            SECTION_HEADINGS[sec_index % len(SECTION_HEADINGS)]
+        ))
+        for p_index in range(paragraphs):
+            text = [_filler(rng, words)]
+            if references:
+                cited = sorted(set(
+                    str(rng.randint(1, references)) for i in range(2)
+                ))
+                text.append('({0})'.format(', '.join(cited)))
+            if total_figures:
+                text.append('(Fig. {0})'.format(
+                    rng.randint(1, total_figures)
+                ))
+            text.append('<em>{0}</em> {1}.'.format(
+                _filler(rng, 2), _filler(rng, words // 4)
+            ))
+            if media_number < media_links:
+                media_number += 1
+                text.append(
+                    '<a href="/index.php/rcr/article/downloadSuppFile/1/'
+                    'video{0}.mp4">Video {0}</a>'.format(media_number)
+                )
+            html.append('<p>{0}</p>'.format(' '.join(text)))
+        # spread the figures over the sections, well-formed ones first
+        while figure_number < total_figures * (sec_index + 1) // sections:
+            figure_number += 1
+            src = '/public/site/images/rcr/fig{0}.jpg'.format(figure_number)
+            caption = 'Figure {0}. {1}'.format(
+                figure_number, _filler(rng, words // 2)
+            )
+            if figure_number <= figures:
+                html.append(
+                    '<p class="figure"><img src="{0}" alt="" />'
+                    '<span class="figureCaption">{1}</span></p>'.format(
+                        src, caption
+                    )
+                )
+            else:
+                html.append('<p><img src="{0}" alt="" /></p>'.format(src))
+                html.append(
+                    '<p class="figureCaption">{0}</p>'.format(caption)
+                )
+
+    html.append('<p class="subheading">References</p>')
+    refs = []
+    for ref_index in range(references):
+        refs.append(
+            '{0}. {1}. <em>Radiology</em>. 2009;250(1):1-6. [<a href='
+            '"http://www.ncbi.nlm.nih.gov/entrez/query.fcgi?cmd=Retrieve&amp;'
+            'db=pubmed&amp;dopt=Abstract&amp;list_uids={2}&amp;query_hl=9"'
+            ' target="_blank">PubMed</a>]<br /><br />'.format(
+                ref_index + 1, _filler(rng, 10), FIRST_PMID + ref_index
+            )
+        )
+    html.append('<p class="references">{0}</p>'.format('\n'.join(refs)))
+    return '\n'.join(html)
+
+
+def make_export_xml(
+    files_dir,
+    article_id=1,
+    volume=5,
+    issue=1,
+    sections=3,
+    paragraphs=4,
+    words=80,
+    figures=4,
+    malformed_figures=2,
+    references=20,
+    media_links=2,
+    galley_files=1,
+    supplemental_files=2,
+    file_size=64 * 1024,
+    seed=0,
+):
+    """return synthetic xml in the form exported by `importExport.php`
+
+    the image, media and pdf files referred to by the export are written
+    to `files_dir`.
+    """
+    rng = random.Random(seed)
+    html = make_article_html(
+        sections=sections,
+        paragraphs=paragraphs,
+        words=words,
+        figures=figures,
+        malformed_figures=malformed_figures,
+        references=references,
+        media_links=media_links,
+        seed=seed,
+    )
+
+    def file_node(tag, filename, stored_name, size):
+        path = _write_file(os.path.join(files_dir, stored_name), size)
+        return '<{0} filename="{1}" file-id="{2}">{3}</{0}>'.format(
+            tag, escape(filename), rng.randint(1, 99999), escape(path)
+        )
+
+    images = [
+        file_node(
+            'image', 'fig{0}.jpg'.format(number),
+            '{0}-{1}-fig{2}.jpg'.format(article_id, rng.randint(1, 999), number),
+            file_size,
+        )
+        for number in range(1, figures + malformed_figures + 1)
+    ]
+    html_files = [
+        file_node(
+            'file', 'galley{0}.html'.format(number),
+            '{0}-galley{1}.html'.format(article_id, number), 1024,
+        )
+        for number in range(1, galley_files + 1)
+    ]
+    supplemental = [
+        file_node(
+            'file', 'original-video{0}.mp4'.format(number),
+            '{0}-video{1}.mp4'.format(article_id, number), file_size,
+        )
+        for number in range(1, max(supplemental_files, media_links) + 1)
+    ]
+    pdf = file_node(
+        'file', 'article.pdf', '{0}-article.pdf'.format(article_id), file_size
+    )
+
+    return """<?xml version="1.0" encoding="utf-8"?>
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="case-report">
+<front>
+<article-meta>
+<article-id pub-id-type="doi">10.2484/rcr.v{volume}i{issue}.{aid}</article-id>
+<title-group><article-title>Synthetic article {aid}</article-title></title-group>
+<volume>{volume}</volume>
+<issue>{issue}</issue>
+</article-meta>
+</front>
+<body>
+<article-markup>{html}</article-markup>
+<galley-files>
+<html-galley galley-id="{aid}1">
+{images}
+{html_files}
+</html-galley>
+<galley galley-id="{aid}2">
+<label>PDF</label>
+{pdf}
+</galley>
+</galley-files>
+<supplemental-files>
+{supplemental}
+</supplemental-files>
+</body>
+</article>
+""".format(
+        aid=article_id,
+        volume=volume,
+        issue=issue,
+        html=escape(html),
+        images='\n'.join(images),
+        html_files='\n'.join(html_files),
+        pdf=pdf,
+        supplemental='\n'.join(supplemental),
+    )
+
+
+def benchmark_article(export, out_path, pubmed_delay=0, html_engine=None):
+    """convert and archive one synthetic export, timing each stage"""
+    metrics = Metrics()
+    with metrics.timer('parse_export'):
+        parsed = parse_export_xml(StringIO(export))
+    archiver = JATSArchiver(
+        parsed, out_path,
+        pubmed_client=make_stub_client(pubmed_delay),
+        metrics=metrics,
+        html_engine=html_engine,
+    )
+    archiver.convert()
+    archiver.archive()
+    return metrics.as_dict(export_bytes=len(export))
+
+
+def _run_case(options, queue):
+    files_dir = tempfile.mkdtemp(prefix='rcr-bench-files-')
+    out_path = tempfile.mkdtemp(prefix='rcr-bench-out-')
+    try:
+        export = make_export_xml(
+            files_dir,
+            sections=options['sections'],
+            paragraphs=options['paragraphs'],
+            words=options['words'],
+            figures=options['figures'],
+            malformed_figures=options['malformed_figures'],
+            references=options['references'],
+            media_links=options['media_links'],
+            supplemental_files=options['supplemental_files'],
+            file_size=options['file_size'],
+        )
+        result = benchmark_article(
+            export, out_path, options['pubmed_delay'], options['html_engine']
+        )
+        archives = [os.path.join(out_path, name) for name in os.listdir(out_path)]
+        result['archive_bytes'] = sum(map(os.path.getsize, archives))
+        result['article_xml_sha1'] = _digest_article_xml(archives)
+        queue.put(result)
+    finally:
+        shutil.rmtree(files_dir)
+        shutil.rmtree(out_path)
+
+
+def _digest_article_xml(archives):
+    # the converted article is the only xml in an archive
+    digest = hashlib.sha1()
+    for archive in sorted(archives):
+        with zipfile.ZipFile(archive) as zf:
+            for name in sorted(zf.namelist()):
+                if name.endswith('.xml'):
+                    digest.update(zf.read(name))
+    return digest.hexdigest()
+
+
+class BenchmarkError(RuntimeError):
+    pass
+
+
+def run_benchmark(options):
+    """run each repetition in a fresh process, so peak RSS is per run
+
+    raises BenchmarkError if a run exits without a result.
+    """
+    results = []
+    for run in range(options['runs']):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_run_case, args=(options, queue)
+        )
+        process.start()
+        results.append(_get_result(queue, process, run + 1))
+        process.join()
+    return results
+
+
+def _get_result(queue, process, run):
+    # a run which crashes never puts its result
+    while True:
+        try:
+            return queue.get(timeout=RESULT_POLL_INTERVAL)
+        except Queue.Empty:
+            if process.is_alive():
+                continue
+        # the result may have been put just before the run exited
+        try:
+            return queue.get(timeout=RESULT_POLL_INTERVAL)
+        except Queue.Empty:
+            process.join()
+            raise BenchmarkError(
+                "run {0} exited with code {1} and no result".format(
+                    run, process.exitcode
+                )
+            )
+
+
+def format_results(results):
+    lines = ["{0:<22}{1:>12}{2:>12}{3:>16}".format(
+        'stage', 'best (ms)', 'mean (ms)', 'max rss +(kB)'
+    )]
+    for stage in STAGES:
+        timings = [r['timings'].get(stage, 0) * 1000 for r in results]
+        growth = max(r['rss_growth_kb'].get(stage, 0) for r in results)
+        lines.append("{0:<22}{1:>12.2f}{2:>12.2f}{3:>16}".format(
+            stage, min(timings), sum(timings) / len(timings), growth
+        ))
+    lines.append('')
+    lines.append('export size:     {0} bytes'.format(results[0]['export_bytes']))
+    lines.append('archive size:    {0} bytes'.format(results[0]['archive_bytes']))
+    lines.append('peak rss:        {0} kB'.format(
+        max(r['peak_rss_kb'] for r in results)
+    ))
+    for counter, value in sorted(results[0]['counters'].items()):
+        lines.append('{0:<17}{1}'.format(counter + ':', value))
+    return '\n'.join(lines)
+
+
+def parse_runs(value):
+    """check a number of runs given on the command line"""
+    try:
+        runs = int(value)
+    except ValueError:
+        runs = 0
+    if runs < 1:
+        raise ArgumentTypeError(
+            "invalid number of runs {0!r}, expected 1 or more".format(value)
+        )
+    return runs
+
+
+def compare_engines(options):
+    """benchmark each html engine on the same export
+
+    returns a dict of the results of each engine, keyed by its name.
+    """
+    results = {}
+    for engine in HTML_ENGINES:
+        results[engine] = run_benchmark(dict(options, html_engine=engine))
+    return results
+
+
+def format_comparison(results):
+    lines = ["{0:<10}{1:>16}{2:>16}{3:>16}".format(
+        'engine', 'parse_html (ms)', 'convert (ms)', 'articles/s'
+    )]
+    for engine in HTML_ENGINES:
+        parse_html = min(r['timings'].get('parse_html', 0)
+                         for r in results[engine])
+        convert = min(r['timings'].get('convert', 0) for r in results[engine])
+        lines.append("{0:<10}{1:>16.2f}{2:>16.2f}{3:>16.1f}".format(
+            engine, parse_html * 1000, convert * 1000,
+            1 / convert if convert else 0,
+        ))
+    digests = set(
+        r['article_xml_sha1'] for engine in HTML_ENGINES
+        for r in results[engine]
+    )
+    lines.append('')
+    lines.append('article xml:     {0}'.format(
+        'identical' if len(digests) == 1 else 'DIFFERS'
+    ))
+    return '\n'.join(lines)
+
+
+DESCRIPTION = """
+Benchmark the conversion and archiving of a synthetic RCR article export.
+The export has the shape of those produced by the PHP JATS exporter, and
+PubMed lookups are answered with canned summaries, so neither an RCR
+installation nor network access is needed. Each run happens in a fresh
+process and reports time and peak memory growth for each stage.
+"""
+
+
+parser = ArgumentParser(description=DESCRIPTION)
+parser.add_argument('--sections', type=int, default=3,
+                    help="Number of article sections (default 3)")
+parser.add_argument('--paragraphs', type=int, default=4,
+                    help="Paragraphs per section (default 4)")
+parser.add_argument('--words', type=int, default=80,
+                    help="Words per paragraph (default 80)")
+parser.add_argument('--figures', type=int, default=4,
+                    help="Number of well-formed 'figure' figures (default 4)")
+parser.add_argument('--malformed-figures', type=int, default=2,
+                    help="Number of 'figureCaption' style figures (default 2)")
+parser.add_argument('--references', type=int, default=20,
+                    help="Number of PubMed linked references (default 20)")
+parser.add_argument('--media-links', type=int, default=2,
+                    help="Number of links to supplemental media (default 2)")
+parser.add_argument('--supplemental-files', type=int, default=2,
+                    help="Number of supplemental files (default 2)")
+parser.add_argument('--file-size', type=int, default=64,
+                    help="Size of each image, media and pdf file in kB "
+                         "(default 64)")
+parser.add_argument('--pubmed-delay', type=float, default=0,
+                    help="Simulated PubMed response time in seconds "
+                         "(default 0)")
+parser.add_argument('--runs', type=parse_runs, default=5,
+                    help="Number of repetitions (default 5)")
+parser.add_argument('--html-engine', choices=HTML_ENGINES,
+                    default=DEFAULT_HTML_ENGINE,
+                    help="Engine parsing the html of the article (default "
+                         "{0})".format(DEFAULT_HTML_ENGINE))
+parser.add_argument('--compare-engines', action='store_true',
+                    help="Run with each html engine, reporting their speed "
+                         "and whether their article xml is identical")
+parser.add_argument('--json', action='store_true',
+                    help="Print raw results as JSON")
+
+
+def main():
+    arguments = parser.parse_args()
+    options = dict(vars(arguments))
+    options['file_size'] = arguments.file_size * 1024
+    try:
+        if arguments.compare_engines:
+            results = compare_engines(options)
+            report = format_comparison
+        else:
+            results = run_benchmark(options)
+            report = format_results
+    except BenchmarkError, e:
+        sys.exit("rcrexport-benchmark: {0}".format(e))
+    if arguments.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print report(results)
+
+
+if __name__ == '__main__':
+    main()
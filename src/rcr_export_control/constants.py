@@ -3,7 +3,7 @@ JATS_NSMAP = {
     'xlink': 'http://www.w3.org/1999/xlink'
 }
 
-JATS_INLINE_ELEMENTS = [
+JATS_INLINE_ELEMENTS = frozenset([
     "email",
     "ext-link",
     "uri",
@@ -63,7 +63,7 @@ JATS_INLINE_ELEMENTS = [
     "xref",
     "sub",
     "sup",
-]
+])
 
 
 HTML_TO_JATS_MAPPING = {
@@ -84,7 +84,7 @@ HTML_TO_JATS_MAPPING = {
 }
 
 
-JATS_SEC_TYPES = [
+JATS_SEC_TYPES = frozenset([
     'cases',
     'conclusions',
     'discussion',
@@ -95,7 +95,7 @@ JATS_SEC_TYPES = [
     'results',
     'subjects',
     'supplementary-material',
-]
+])
 
 
 RCR_TO_JATS_SEC_MAPPING = {
@@ -120,11 +120,11 @@ RCR_DOMAINS = [
 ]
 
 
-MEDIA_MIME_TYPE_PREFIXES = [
+MEDIA_MIME_TYPE_PREFIXES = frozenset([
     'x-conference',
     'image',
     'application',
     'video',
     'model',
     'audio',
-]
\ No newline at end of file
+])
\ No newline at end of file
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+from rcr_export_control.log import deferred
+from rcr_export_control.xml_tools import get_index_from_figure_ref
+from rcr_export_control.xml_tools import get_namespaced_attribute
+from rcr_export_control.xml_tools import is_internal
+from rcr_export_control.xml_tools import iter_citation_tokens
+from rcr_export_control.xml_tools import set_namespaced_attribute
+
+import os
+
+
+class CrosslinkResolver(object):
+    """base class for the resolvers dispatched to by a CrosslinkEngine
+
+    a resolver is handed every element whose tag is in `tags`, and is asked
+    for an xref for every inline citation token whose kind is in `kinds`
+    (see xml_tools.iter_citation_tokens).  State shared with the rest of the
+    conversion, like files to archive, is kept on the archiver.
+    """
+    tags = ()
+    kinds = ()
+
+    def __init__(self, archiver):
+        self.archiver = archiver
+
+    def resolve_element(self, node):
+        """fix up an element with one of our tags in place"""
+        raise NotImplementedError
+
+    def make_xref(self, kind, value):
+        """return an xref element for an inline citation of `value`"""
+        raise NotImplementedError
+
+
+class FigureResolver(CrosslinkResolver):
+    """link inline citations like '(Figs. 1, 2A)' to their figures"""
+    kinds = ('fig',)
+
+    def make_xref(self, kind, value):
+        xref = etree.Element('xref')
+        xref.text = value
+        xref.attrib['rid'] = self._get_figure_id(value)
+        xref.attrib['ref-type'] = 'fig'
+        self.archiver.metrics.increment('figure_xrefs')
+        return xref
+
+    def _get_figure_id(self, ref):
+        """return the id of the figure cited by a reference like '2a'"""
+        fig_index = get_index_from_figure_ref(ref)
+        try:
+            # a reference to figure 0 must not wrap around to the last one
+            if fig_index is None or fig_index < 0:
+                raise IndexError(fig_index)
+            return self.archiver.figure_list[fig_index].attrib['id']
+        except IndexError:
+            msg = "ERROR\nUnable to find figure %s while resolving "
+            msg += "figure references.  Please check the "
+            msg += "original html."
+            self.archiver.crosslink_log.error(msg, ref)
+            self.archiver.report('missing-figure', citation=ref)
+            return "placeholder"
+
+
+class BibliographyResolver(CrosslinkResolver):
+    """link inline citations like '(1, 2)' to the reference list"""
+    kinds = ('bibr',)
+
+    def make_xref(self, kind, value):
+        self.archiver.crosslink_log.debug(
+            "Processing inline citation to %s", value
+        )
+        xref = etree.Element('xref')
+        xref.text = value
+        xref.attrib['rid'] = 'ref-{0}'.format(value)
+        xref.attrib['ref-type'] = 'bibr'
+        self.archiver.metrics.increment('reference_xrefs')
+        return xref
+
+
+class MediaLinkResolver(CrosslinkResolver):
+    """point internal media links at the files stored in the archive"""
+    tags = ('media',)
+
+    def resolve_element(self, link):
+        archiver = self.archiver
+        href = get_namespaced_attribute(link, 'href', 'xlink')
+        # if the href is internal, this points to a file on the server
+        # and we must archive and fix the reference, otherwise, we can
+        # leave it alone
+        if not is_internal(href):
+            return
+
+        archiver.crosslink_log.info(
+            "Internal media link found\n%s", deferred(etree.tostring, link)
+        )
+        filename = os.path.basename(href)
+        file_infos = []
+        file_infos.extend(archiver._find_file_infos(filename))
+        if not file_infos:
+            file_infos.extend(
+                archiver._find_file_infos(filename, by_path=True)
+            )
+
+        # one last check
+        if file_infos:
+            file_info = file_infos[0]
+            if file_info is not None:
+                media_count = len(archiver.media_files_to_archive) + 1
+                new_filename = archiver._make_archive_filename(
+                    file_info, media_count, 's'
+                )
+                archiver.media_files_to_archive[new_filename] = file_info['path']
+                archiver.metrics.increment('media_files')
+                set_namespaced_attribute(
+                    link, 'href', new_filename, 'xlink'
+                )
+                archiver.crosslink_log.debug(
+                    "Linking to file\n%s", file_info['path']
+                )
+
+            if len(file_infos) > 1:
+                msg = "WARNING\nUnable to uniquely identify a candidate "
+                msg += "file from the link '%s'. Using the first "
+                msg += "identified file from path '%s'"
+                archiver.crosslink_log.warning(msg, href, file_info['path'])
+                archiver.report(
+                    'ambiguous-media', href=href,
+                    candidates=[info.get('path') for info in file_infos],
+                )
+        else:
+            msg = "ERROR\nUnable to resolve a reference to the media file "
+            msg += "'%s' from link '%s'. Please check the original "
+            msg += "and the output archive for this article."
+            archiver.crosslink_log.error(msg, filename, href)
+            archiver.report('unresolved-media', href=href)
+
+
+class CrosslinkEngine(object):
+    """resolve every kind of crosslink in a single walk of the tree
+
+    each element is visited once.  Elements are handed to the resolvers
+    registered for their tag, and inline citations found in the text of
+    the citation scopes (and their descendants) are replaced by the xrefs
+    the resolvers registered for their kind build.
+    """
+
+    def __init__(self, resolvers):
+        self.element_resolvers = {}
+        self.citation_resolvers = {}
+        for resolver in resolvers:
+            for tag in resolver.tags:
+                self.element_resolvers.setdefault(tag, []).append(resolver)
+            for kind in resolver.kinds:
+                self.citation_resolvers[kind] = resolver
+
+    def run(self, root, citation_scopes=()):
+        scopes = set(citation_scopes)
+        self._visit(root, scopes, root in scopes)
+
+    def _visit(self, node, scopes, cite):
+        # xrefs are inserted as we go, take the children beforehand so they
+        # are not visited again
+        children = list(node)
+        if cite and node.text:
+            self._process_text(node, node.text)
+        for resolver in self.element_resolvers.get(node.tag, ()):
+            resolver.resolve_element(node)
+        for child in children:
+            self._visit(child, scopes, cite or child in scopes)
+        if cite and node.tail:
+            self._process_text(node, node.tail, False)
+
+    def _process_text(self, node, text, as_text=True):
+        """split the text or tail of node around xrefs for inline citations
+
+        xrefs found in the text of node become its first children, those
+        found in the tail of node become its next siblings.  The text before
+        the first xref stays the text or tail of node, the text following
+        each xref becomes its tail.
+        """
+        inserted = None
+        cited = None
+        index = 0
+        pending = []
+        for kind, value in iter_citation_tokens(text):
+            if kind == 'fig-suffix' and cited is not None:
+                # references like "(Figs 1A, C)", the trailing part belongs
+                # to the previous figure xref
+                cited.text += value
+                continue
+            resolver = self.citation_resolvers.get(kind)
+            if resolver is None:
+                # plain text, or a citation nobody resolves
+                pending.append(value)
+                cited = None
+                continue
+            cited = resolver.make_xref(kind, value)
+            if as_text:
+                node.insert(index, cited)
+                index += 1
+            elif inserted is not None:
+                inserted.addnext(cited)
+            else:
+                node.addnext(cited)
+            # addnext moves the tail of the element before the xref onto
+            # it, so text is only placed once the xref is in the tree
+            self._place_text(node, inserted, pending, as_text)
+            pending = []
+            inserted = cited
+        self._place_text(node, inserted, pending, as_text)
+
+    def _place_text(self, node, inserted, pieces, as_text):
+        """set the text following an inserted xref, or node if None"""
+        text = ''.join(pieces) or None
+        if inserted is not None:
+            inserted.tail = text
+        elif as_text:
+            node.text = text
+        else:
+            node.tail = text
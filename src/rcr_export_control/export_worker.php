@@ -0,0 +1,76 @@
+<?php
+
+/**
+ * export_worker.php
+ *
+ * Export articles on request, loading OJS and the export plugin once rather
+ * than for every article as tools/importExport.php does.  Reads lines of
+ * "ID /path/to/export.xml" on stdin, exports article ID of the journal to
+ * that path with the plugin and answers each line with "ok", or with
+ * "error <message>" if the export failed, until its input ends.  Started by
+ * rcrexport with --export-worker, once for each concurrent export:
+ *
+ *   php export_worker.php /path/to/ojs JATSImportExportPlugin journal
+ *
+ * The OJS installation is only read, never changed.
+ */
+
+if (count($argv) < 4) {
+	fwrite(STDERR, "Usage: php export_worker.php /path/to/ojs plugin journal\n");
+	exit(1);
+}
+
+define('INDEX_FILE_LOCATION', realpath($argv[1]) . '/index.php');
+require(dirname(INDEX_FILE_LOCATION) . '/lib/pkp/classes/cliTool/CliTool.inc.php');
+
+class ExportWorkerTool extends CommandLineTool {
+
+	function execute() {
+		list($pluginName, $journalPath) = $this->argv;
+		PluginRegistry::loadCategory('importexport');
+		$plugin =& PluginRegistry::getPlugin('importexport', $pluginName);
+		if (!$plugin) {
+			$this->fail("No import/export plugin named \"$pluginName\"");
+		}
+
+		while (($line = fgets(STDIN)) !== false) {
+			$line = trim($line);
+			if ($line === '') continue;
+			$request = preg_split('/\s+/', $line, 2);
+			if (count($request) < 2 || !ctype_digit($request[0])) {
+				$this->reply("error malformed request \"$line\"");
+				continue;
+			}
+			list($articleId, $path) = $request;
+
+			// the same arguments importExport.php hands the plugin.  Anything
+			// it prints is an error, as rcrexport takes it for a single run.
+			ob_start();
+			$plugin->executeCLI($this->scriptName, array('export', $path, $journalPath, 'article', $articleId));
+			$output = trim(ob_get_clean());
+			clearstatcache();
+			if ($output !== '') {
+				$this->reply('error ' . preg_replace('/\s+/', ' ', $output));
+			} elseif (!is_file($path) || filesize($path) == 0) {
+				$this->reply("error nothing exported for article $articleId");
+			} else {
+				$this->reply('ok');
+			}
+		}
+	}
+
+	function reply($message) {
+		echo $message . "\n";
+		fflush(STDOUT);
+	}
+
+	function fail($message) {
+		fwrite(STDERR, $message . "\n");
+		exit(1);
+	}
+}
+
+$tool = new ExportWorkerTool(isset($argv) ? array_merge(array($argv[0]), array_slice($argv, 2)) : array());
+$tool->execute();
+
+?>
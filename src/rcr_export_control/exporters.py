@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""ways of running the PHP export of an article
+
+an exporter has an `export(articleid, out_path)` method, raising
+CalledProcessError if the export fails, and a `close()` method.
+"""
+from rcr_export_control import make_php_command
+from rcr_export_control.utils import execute_php_export
+from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import Popen
+
+import shlex
+
+
+class ScriptExporter(object):
+    """export each article with a fresh run of importExport.php"""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def export(self, articleid, out_path):
+        command = make_php_command(articleid, out_path, self.settings)
+        execute_php_export(command, articleid)
+
+    def close(self):
+        pass
+
+
+class PersistentExporter(object):
+    """export articles through a long running export process
+
+    for each article the process is sent a line "<articleid> <path>" on its
+    stdin. It writes the export of the article to path and answers with a
+    line "ok" on its stdout, or "error <message>" on failure.  The process
+    is started on first use and restarted if it exits.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+
+    def export(self, articleid, out_path):
+        if self.process is None or self.process.poll() is not None:
+            # a worker holding the pipes of another open would keep it from
+            # seeing the end of its input when closed
+            self.process = Popen(
+                shlex.split(self.command), stdin=PIPE, stdout=PIPE,
+                close_fds=True,
+            )
+        try:
+            self.process.stdin.write('{0} {1}\n'.format(articleid, out_path))
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline().strip()
+        except IOError:
+            reply = ''
+        if not reply:
+            self.close()
+            raise CalledProcessError(
+                1, self.command, output="export worker exited"
+            )
+        if reply != 'ok':
+            raise CalledProcessError(
+                1, self.command, output=reply.partition(' ')[2]
+            )
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait()
+            self.process = None
+
+
+def make_exporters(settings, count, php_worker=None):
+    """return `count` exporters, persistent if a worker command is given"""
+    if php_worker:
+        return [PersistentExporter(php_worker) for index in range(count)]
+    return [ScriptExporter(settings) for index in range(count)]
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""engines parsing the html markup of articles
+
+the 'soup' engine parses with BeautifulSoup, the 'lxml' engine parses
+straight into lxml.html element trees, which is several times faster.  The
+lxml trees are wrapped in `HtmlTag` and `HtmlText` nodes, which offer the
+small part of the BeautifulSoup api used in converting articles, so the same
+code converts the trees of either engine.
+"""
+from bs4 import BeautifulSoup
+from bs4 import element
+from lxml import etree
+
+import lxml.html
+
+
+SOUP_ENGINE = 'soup'
+LXML_ENGINE = 'lxml'
+HTML_ENGINES = (SOUP_ENGINE, LXML_ENGINE)
+DEFAULT_HTML_ENGINE = SOUP_ENGINE
+# the parser used by BeautifulSoup, named so that it does not vary by host
+SOUP_FEATURES = 'lxml'
+
+
+def parse_html(markup, engine=DEFAULT_HTML_ENGINE):
+    """parse html markup with the named engine
+
+    >>> html = parse_html(u'<p class="subheading">Case</p> text', 'lxml')
+    >>> [tag.text for tag in html.find_all('p', class_='subheading')]
+    [u'Case']
+    """
+    if engine == SOUP_ENGINE:
+        return BeautifulSoup(markup, SOUP_FEATURES)
+    if engine == LXML_ENGINE:
+        if not markup or not markup.strip():
+            return HtmlTag(lxml.html.Element('html'))
+        return HtmlTag(lxml.html.document_fromstring(markup))
+    raise ValueError("unknown html engine {0!r}".format(engine))
+
+
+def release(node):
+    """remove an element from its tree, freeing it once unreferenced
+
+    BeautifulSoup trees are full of reference cycles, so a tag is left for
+    the garbage collector unless it is decomposed.  Any text following an
+    lxml element is kept in the tree.
+    """
+    if isinstance(node, HtmlTag):
+        if node.element.getparent() is not None:
+            node.element.drop_tree()
+    elif isinstance(node, element.Tag):
+        node.decompose()
+
+
+def tag_classes(tag):
+    """return the set of the classes of a tag, in lower case
+
+    >>> html = parse_html(u'<p class="Figure x">Fig</p>', 'lxml')
+    >>> sorted(tag_classes(html.find('p')))
+    ['figure', 'x']
+    """
+    return frozenset(name.lower() for name in tag.get('class', ()))
+
+
+def is_tag(node):
+    """determine if a node of a parsed html tree is an element"""
+    return isinstance(node, (element.Tag, HtmlTag))
+
+
+def is_text(node):
+    """determine if a node of a parsed html tree is a run of text"""
+    return isinstance(node, (element.NavigableString, HtmlText))
+
+
+class HtmlText(unicode):
+    """a run of text in an lxml.html tree, like a NavigableString"""
+
+    __slots__ = ()
+
+    @property
+    def string(self):
+        return self
+
+
+def _wrap_nodes(nodes):
+    """yield each of a run of lxml nodes, followed by its tail"""
+    for node in nodes:
+        if isinstance(node.tag, basestring):
+            yield HtmlTag(node)
+        elif node.text:
+            # BeautifulSoup yields comments as strings of their own
+            yield HtmlText(node.text)
+        if node.tail:
+            yield HtmlText(node.tail)
+
+
+def _matches(node, name, class_):
+    if name is not None and node.tag != name:
+        return False
+    if class_ is not None:
+        classes = node.get('class')
+        if classes is None:
+            return False
+        return class_ == classes or class_ in classes.split()
+    return True
+
+
+class HtmlTag(object):
+    """an element of an lxml.html tree, like a BeautifulSoup Tag"""
+
+    __slots__ = ('element', )
+
+    def __init__(self, element):
+        self.element = element
+
+    def __eq__(self, other):
+        return isinstance(other, HtmlTag) and other.element is self.element
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.element)
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def __unicode__(self):
+        return lxml.html.tostring(
+            self.element, encoding=unicode, with_tail=False
+        )
+
+    def _get_name(self):
+        return self.element.tag
+
+    def _set_name(self, name):
+        self.element.tag = name
+
+    name = property(_get_name, _set_name)
+
+    @property
+    def text(self):
+        # the text of elements only, as comments are left out by BeautifulSoup
+        return u''.join(self.element.itertext(etree.Element))
+
+    @property
+    def children(self):
+        if self.element.text:
+            yield HtmlText(self.element.text)
+        for node in _wrap_nodes(self.element):
+            yield node
+
+    @property
+    def next_siblings(self):
+        if self.element.tail:
+            yield HtmlText(self.element.tail)
+        for node in _wrap_nodes(self.element.itersiblings()):
+            yield node
+
+    def get(self, key, default=None):
+        value = self.element.get(key)
+        if value is None:
+            return default
+        if key == 'class':
+            # like BeautifulSoup, class is a list of names
+            return value.split()
+        return value
+
+    def __getitem__(self, key):
+        return self.element.attrib[key]
+
+    def find_all(self, name=None, class_=None):
+        """return the descendants with a tag name and class"""
+        return [
+            HtmlTag(node) for node in self.element.iterdescendants()
+            if isinstance(node.tag, basestring) and
+            _matches(node, name, class_)
+        ]
+
+    def find(self, name=None, class_=None):
+        """return the first descendant with a tag name and class, or None"""
+        for node in self.element.iterdescendants():
+            if isinstance(node.tag, basestring) and \
+                    _matches(node, name, class_):
+                return HtmlTag(node)
+        return None
@@ -0,0 +1,80 @@
+<?php
+
+/**
+ * list_articles.php
+ *
+ * Print the ids of published articles of a journal, one per line, in the
+ * order they appear in their issues.  Used by rcrexport to find the articles
+ * of an issue, of a volume or published since a date:
+ *
+ *   php list_articles.php /path/to/ojs journal issue VOLUME NUMBER
+ *   php list_articles.php /path/to/ojs journal volume VOLUME
+ *   php list_articles.php /path/to/ojs journal since YYYY-MM-DD
+ *
+ * The OJS installation is only read, never changed.
+ */
+
+if (count($argv) < 4) {
+	fwrite(STDERR, "Usage: php list_articles.php /path/to/ojs journal issue VOLUME NUMBER|volume VOLUME|since YYYY-MM-DD\n");
+	exit(1);
+}
+
+define('INDEX_FILE_LOCATION', realpath($argv[1]) . '/index.php');
+require(dirname(INDEX_FILE_LOCATION) . '/lib/pkp/classes/cliTool/CliTool.inc.php');
+
+class ListArticlesTool extends CommandLineTool {
+
+	function execute() {
+		list($journalPath, $mode) = $this->argv;
+		$journalDao =& DAORegistry::getDAO('JournalDAO');
+		$journal =& $journalDao->getJournalByPath($journalPath);
+		if (!$journal) {
+			$this->fail("No journal found at path \"$journalPath\"");
+		}
+
+		$issueDao =& DAORegistry::getDAO('IssueDAO');
+		$since = null;
+		switch ($mode) {
+			case 'issue':
+				if (count($this->argv) < 4) $this->fail('Issue requires a volume and a number');
+				$issues =& $issueDao->getPublishedIssuesByNumber($journal->getId(), (int) $this->argv[2], $this->argv[3]);
+				break;
+			case 'volume':
+				if (count($this->argv) < 3) $this->fail('Volume requires a volume');
+				$issues =& $issueDao->getPublishedIssuesByNumber($journal->getId(), (int) $this->argv[2]);
+				break;
+			case 'since':
+				if (count($this->argv) < 3 || ($since = strtotime($this->argv[2])) === false) {
+					$this->fail('Since requires a date');
+				}
+				$issues =& $issueDao->getPublishedIssues($journal->getId());
+				break;
+			default:
+				$this->fail("Unknown mode \"$mode\"");
+		}
+
+		$publishedArticleDao =& DAORegistry::getDAO('PublishedArticleDAO');
+		while ($issue =& $issues->next()) {
+			$articles =& $publishedArticleDao->getPublishedArticles($issue->getId());
+			foreach ($articles as $article) {
+				if ($since !== null) {
+					$published = $article->getDatePublished();
+					if (!$published) $published = $issue->getDatePublished();
+					if (strtotime($published) < $since) continue;
+				}
+				echo $article->getId() . "\n";
+			}
+			unset($issue);
+		}
+	}
+
+	function fail($message) {
+		fwrite(STDERR, $message . "\n");
+		exit(1);
+	}
+}
+
+$tool = new ListArticlesTool(isset($argv) ? array_merge(array($argv[0]), array_slice($argv, 2)) : array());
+$tool->execute();
+
+?>
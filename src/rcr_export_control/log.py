@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""logging of export and conversion progress
+
+messages are logged to a category of the 'rcr_export_control' logger, like
+'rcr_export_control.figures'.  The first line of a message is its header,
+any further lines are detail, like the html of the tag being converted.
+
+Messages are logged with %-style arguments, or with `deferred` calls for
+detail which is costly to produce, so that nothing is formatted for a
+message below the level of its category.
+"""
+from argparse import ArgumentTypeError
+from textwrap import TextWrapper
+
+import json
+import logging
+import sys
+import threading
+
+
+LOGGER_NAME = 'rcr_export_control'
+# categories of messages, each a child of the package logger
+CATEGORIES = (
+    'export', 'sections', 'figures', 'references', 'crosslinks', 'archive',
+)
+# progress worth showing unless asked to be quiet, between info and warning
+NOTICE = 25
+logging.addLevelName(NOTICE, 'NOTICE')
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'notice': NOTICE,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+# the level shown by default and with each '-q' given
+QUIET_LEVELS = [logging.DEBUG, logging.INFO, NOTICE, logging.WARNING]
+# extra fields of records written out as JSON, if present
+CONTEXT_FIELDS = ('article', 'archive')
+
+# handlers installed by `configure_logging`
+_handlers = []
+# stay silent when used as a library, until logging is configured
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+def get_logger(category=None, **context):
+    """return the logger of a category, adding `context` to its records"""
+    name = LOGGER_NAME
+    if category is not None:
+        name = '.'.join([LOGGER_NAME, category])
+    logger = logging.getLogger(name)
+    if context:
+        return logging.LoggerAdapter(logger, context)
+    return logger
+
+
+class deferred(object):
+    """a call made only once the message logging it is formatted
+
+    >>> calls = []
+    >>> detail = deferred(calls.append, 'done')
+    >>> calls
+    []
+    >>> str(detail), calls
+    ('None', ['done'])
+    """
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def parse_log_level(value):
+    """parse a level given as CATEGORY=LEVEL, or LEVEL for all categories
+
+    >>> parse_log_level('figures=debug')
+    ('figures', 10)
+    >>> parse_log_level('WARNING')
+    (None, 30)
+    """
+    category, sep, level = value.rpartition('=')
+    if not sep:
+        category = None
+    elif category not in CATEGORIES:
+        raise ArgumentTypeError(
+            "unknown log category {0!r}, expected one of {1}".format(
+                category, ', '.join(CATEGORIES)
+            )
+        )
+    try:
+        return category, LEVELS[level.lower()]
+    except KeyError:
+        raise ArgumentTypeError(
+            "unknown log level {0!r}, expected one of {1}".format(
+                level, ', '.join(sorted(LEVELS, key=LEVELS.get))
+            )
+        )
+
+
+class TextFormatter(logging.Formatter):
+    """format messages as a header followed by indented, wrapped detail"""
+
+    def __init__(self):
+        logging.Formatter.__init__(self)
+        self.text_wrapper = TextWrapper(
+            initial_indent="   ", subsequent_indent="   "
+        )
+
+    def format(self, record):
+        header, sep, detail = record.getMessage().partition('\n')
+        lines = [header]
+        if detail.strip():
+            lines.append(self.text_wrapper.fill(detail))
+        if record.exc_info:
+            lines.append(self.formatException(record.exc_info))
+        # a blank line between messages
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class JSONFormatter(logging.Formatter):
+    """format messages as a line of JSON each"""
+
+    def format(self, record):
+        header, sep, detail = record.getMessage().partition('\n')
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'category': record.name.rpartition('.')[2],
+            'message': header,
+        }
+        if detail.strip():
+            entry['detail'] = detail.strip()
+        for field in CONTEXT_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True)
+
+
+def configure_logging(
+    quiet=0, levels=(), path=None, as_json=False, stream=None
+):
+    """log messages to `stream`, by default stdout, or to the file at `path`
+
+    each of `quiet` raises the level of messages shown by one step, from
+    debug to warning.  `levels` is a sequence of (category, level) pairs,
+    which override the level of a category, or of all of them if category
+    is None.  Replaces any logging configured before.
+    """
+    logger = get_logger()
+    for handler in _handlers:
+        logger.removeHandler(handler)
+        handler.close()
+    del _handlers[:]
+
+    if path is not None:
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler(stream or sys.stdout)
+    if as_json:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+    logger.addHandler(handler)
+    _handlers.append(handler)
+    # messages are for our handler only, not the root logger of a host
+    logger.propagate = False
+
+    level = QUIET_LEVELS[min(quiet or 0, len(QUIET_LEVELS) - 1)]
+    category_levels = dict.fromkeys(CATEGORIES, logging.NOTSET)
+    for category, category_level in levels:
+        if category is None:
+            level = category_level
+        else:
+            category_levels[category] = category_level
+    logger.setLevel(level)
+    for category, category_level in category_levels.items():
+        get_logger(category).setLevel(category_level)
+
+
+def reset_after_fork():
+    """make logging usable in a process forked from a threaded one
+
+    a thread of the parent may have held a logging lock as it forked, which
+    would then never be released in the child.
+    """
+    logging._lock = threading.RLock()
+    for handler in _handlers:
+        handler.createLock()
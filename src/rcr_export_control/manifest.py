@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+from rcr_export_control.archiver import PUBMED_TRANSFORM_PATH
+from rcr_export_control.xml_tools import iter_sanitized_chunks
+from rcr_export_control.zipwriter import ArchiveWriter
+
+import hashlib
+import json
+import os
+import pkg_resources
+import tempfile
+import time
+import zipfile
+
+
+MANIFEST_FILENAME = '.rcrexport-manifest.json'
+HASH_CHUNK_SIZE = 64 * 1024
+# the manifest is saved once this many articles or seconds have passed
+MANIFEST_SAVE_BATCH = 50
+MANIFEST_SAVE_INTERVAL = 60
+# the code converting articles, part of the fingerprint of the tool
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+# the settings which change the archive made of an article
+OUTPUT_SETTINGS = ('html_engine', 'section_mapping', 'schema_path')
+
+# the outcomes of an incremental export, see `check_article`
+CHANGED = 'changed'
+FILES_CHANGED = 'files changed'
+UNCHANGED = 'unchanged'
+
+_tool_fingerprint = None
+
+
+def hash_file(path):
+    """return the sha1 hex digest of the content of the file at path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def fingerprint_export(exported):
+    """return the sha1 hex digest of the sanitized xml exported from PHP"""
+    digest = hashlib.sha1()
+    for chunk in iter_sanitized_chunks(exported):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path, previous=None):
+    """return a dict of the size, mtime and content hash of a file
+
+    the content hash is reused from `previous` when the size and mtime of
+    the file have not changed since.
+    """
+    stat = os.stat(path)
+    fingerprint = {
+        'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime
+    }
+    if previous is not None and previous.get('path') == path and \
+            previous.get('size') == stat.st_size and \
+            previous.get('mtime') == stat.st_mtime:
+        fingerprint['sha1'] = previous['sha1']
+    else:
+        fingerprint['sha1'] = hash_file(path)
+    return fingerprint
+
+
+def hash_sources(directory=PACKAGE_PATH):
+    """return the sha1 hex digest of the python sources in a directory"""
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            digest.update(name)
+            digest.update(hash_file(os.path.join(directory, name)))
+    return digest.hexdigest()
+
+
+def get_tool_fingerprint():
+    """identify the version of this tool, its code and reference transform
+
+    archives made by a different version are never reused.  The version
+    alone is not enough, it stays the same while the code changes.
+    """
+    global _tool_fingerprint
+    if _tool_fingerprint is None:
+        try:
+            version = pkg_resources.get_distribution(
+                'rcr_export_control'
+            ).version
+        except pkg_resources.DistributionNotFound:
+            version = 'unknown'
+        _tool_fingerprint = '{0}:{1}:{2}'.format(
+            version, hash_sources(), hash_file(PUBMED_TRANSFORM_PATH)
+        )
+    return _tool_fingerprint
+
+
+def fingerprint_settings(settings):
+    """return the sha1 hex digest of the settings which change archives
+
+    like the html engine and the contents of the section mapping.
+    """
+    chosen = dict((key, settings.get(key)) for key in OUTPUT_SETTINGS)
+    return hashlib.sha1(json.dumps(chosen, sort_keys=True)).hexdigest()
+
+
+def make_entry(
+    export_fingerprint, archive_path, sources, previous=None, settings=None,
+):
+    """return the manifest entry for an article archived at archive_path
+
+    `sources` maps the name of each file in the archive, other than the
+    article xml, to the path of the file it was copied from.  `settings`
+    are those the article was converted with.
+    """
+    previous_files = {}
+    if previous is not None:
+        previous_files = previous.get('files', {})
+    files = {}
+    for name, path in sources.items():
+        files[name] = fingerprint_file(path, previous_files.get(name))
+    return {
+        'export': export_fingerprint,
+        'tool': get_tool_fingerprint(),
+        'settings': fingerprint_settings(settings or {}),
+        'archive': os.path.basename(archive_path),
+        'files': files,
+    }
+
+
+def check_article(entry, export_fingerprint, output_path, settings=None):
+    """return how an article has changed since its manifest entry was made
+
+    one of CHANGED, if the article must be converted again, FILES_CHANGED,
+    if only files copied into its archive have changed, or UNCHANGED.  An
+    article is also CHANGED if the tool or the `settings` it is converted
+    with have changed.
+    """
+    if entry is None or entry['export'] != export_fingerprint or \
+            entry['tool'] != get_tool_fingerprint() or \
+            entry.get('settings') != fingerprint_settings(settings or {}):
+        return CHANGED
+    if not os.path.exists(os.path.join(output_path, entry['archive'])):
+        return CHANGED
+
+    for name, previous in entry['files'].items():
+        if not os.path.exists(previous['path']):
+            return CHANGED
+        if fingerprint_file(previous['path'], previous) != previous:
+            return FILES_CHANGED
+    return UNCHANGED
+
+
+def rebuild_archive(entry, output_path, media_store=None):
+    """archive the files of an article again, reusing its converted xml
+
+    returns the path to the archive written.  Files deflated before are
+    copied from `media_store`, if given.
+    """
+    archive_path = os.path.join(output_path, entry['archive'])
+    files = entry['files']
+    with zipfile.ZipFile(archive_path) as previous:
+        with ArchiveWriter(archive_path, store=media_store) as archive:
+            for name in previous.namelist():
+                if name in files:
+                    continue
+                # the converted article xml
+                with archive.open_entry(name) as zip_entry:
+                    zip_entry.write(previous.read(name))
+            for name, fingerprint in files.items():
+                archive.write(fingerprint['path'], name)
+    return archive_path
+
+
+class ExportManifest(object):
+    """record of the articles archived in an output directory
+
+    for each article the manifest holds a fingerprint of the sanitized
+    export xml, of the tool version and code, of the settings it was
+    converted with and of each file copied into the archive, so that
+    articles which have not changed since they were last archived can be
+    skipped.
+    """
+
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, MANIFEST_FILENAME)
+        self.articles = {}
+        self.unsaved = 0
+        self.saved = time.time()
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                self.articles = json.load(fh)
+
+    def get(self, articleid):
+        return self.articles.get(str(articleid))
+
+    def update(self, articleid, entry):
+        self.articles[str(articleid)] = entry
+        self.unsaved += 1
+
+    def save_if_due(self):
+        """save the manifest if enough articles or time have passed
+
+        rewriting the whole manifest for every article would cost more
+        the more articles it holds.  Articles not yet saved are converted
+        again if the export is interrupted.
+        """
+        if self.unsaved >= MANIFEST_SAVE_BATCH or \
+                time.time() - self.saved >= MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """write the manifest, replacing the previous one atomically"""
+        if not self.unsaved:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(self.articles, fh, indent=1, sort_keys=True)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        self.unsaved = 0
+        self.saved = time.time()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+from rcr_export_control.manifest import hash_file
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+DEFAULT_STORE_SIZE = 1024 * 1024 * 1024         # 1 GB of deflated data
+# smaller files deflate in less time than it takes to look them up
+MIN_STORED_SIZE = 64 * 1024
+INDEX_FILENAME = 'index.sqlite'
+
+# the content digest of each file seen, valid while its size and mtime hold
+CREATE_FILES_TABLE = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+# the crc and sizes of each stored blob of deflated data
+CREATE_BLOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    crc INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    compress_size INTEGER NOT NULL,
+    used REAL NOT NULL
+)
+"""
+# the crc of each file copied into archives uncompressed, valid while its
+# size and mtime hold.  Their data is read into each archive anyway, so it
+# is not kept.
+CREATE_CHECKSUMS_TABLE = """
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    crc INTEGER NOT NULL
+)
+"""
+
+
+class MediaStore(object):
+    """content-addressed store of deflated files, shared by article archives
+
+    galley images and supplemental files are often the same in many
+    articles.  Each file deflated into an archive is kept in `directory`,
+    keyed by the sha1 digest of its content, with its crc and sizes, so the
+    next archive holding the same content can copy the deflated data into
+    its zip as it is.  For files archived uncompressed, such as images, only
+    the crc is kept, so they are copied without computing it again.  Files
+    are recognized by path, size and mtime without
+    being read again, or else by the digest of their content.  Once the
+    stored data exceeds `max_size` bytes the least recently used blobs are
+    evicted.  The index is an sqlite database, so the store may be shared by
+    several export processes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_STORE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.min_size = MIN_STORED_SIZE
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        # connect lazily and once for each thread, as `PubMedCache` does
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.index_path, timeout=30, check_same_thread=False
+            )
+            connection.text_factory = str
+            connection.execute(CREATE_FILES_TABLE)
+            connection.execute(CREATE_BLOBS_TABLE)
+            connection.execute(CREATE_CHECKSUMS_TABLE)
+            connection.commit()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def blob_path(self, digest):
+        """return the path of the blob holding content with digest"""
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, path):
+        """find the stored deflated data of the file at path
+
+        returns a tuple of (digest, blob), where blob is a tuple of (crc,
+        size, compress_size, blob_path), or None if the content of the file
+        is not stored.  The digest is passed to `add` once the file has been
+        deflated.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.connection as connection:
+            row = connection.execute(
+                "SELECT digest FROM files "
+                "WHERE path = ? AND size = ? AND mtime = ?",
+                (path, stat.st_size, stat.st_mtime)
+            ).fetchone()
+            if row is None:
+                digest = hash_file(path)
+                connection.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime, digest)
+                )
+            else:
+                digest = row[0]
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    "SELECT crc, size, compress_size FROM blobs "
+                    "WHERE digest = ?", (digest, )
+                )
+                row = cursor.fetchone()
+            if row is None:
+                return digest, None
+            connection.execute(
+                "UPDATE blobs SET used = ? WHERE digest = ?",
+                (time.time(), digest)
+            )
+        return digest, tuple(row) + (self.blob_path(digest), )
+
+    def lookup_crc(self, path, stat):
+        """return the crc of the uncompressed file at path, or None
+
+        the crc is only known while the size and mtime of the file match
+        `stat`, the file is not read.
+        """
+        with self.connection as connection:
+            row = connection.execute(
+                "SELECT crc FROM checksums "
+                "WHERE path = ? AND size = ? AND mtime = ?",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def add_crc(self, path, stat, crc):
+        """record the crc of the uncompressed file at path as of `stat`"""
+        with self.connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime, crc)
+            )
+
+    def add(self, digest, crc, size, data):
+        """store the raw deflated data of content with digest"""
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            directory = os.path.dirname(blob_path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # made by another process meanwhile
+                    if not os.path.isdir(directory):
+                        raise
+            # readers in other processes never see a partly written blob
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    fh.write(data)
+                os.rename(temp_path, blob_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+        with self.connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                (digest, crc, size, len(data), time.time())
+            )
+        self.evict()
+
+    def evict(self):
+        """drop least recently used blobs until within `max_size`"""
+        with self.connection as connection:
+            total = connection.execute(
+                "SELECT COALESCE(SUM(compress_size), 0) FROM blobs"
+            ).fetchone()[0]
+            if total <= self.max_size:
+                return
+            rows = connection.execute(
+                "SELECT digest, compress_size FROM blobs ORDER BY used"
+            ).fetchall()
+            doomed = []
+            for digest, compress_size in rows:
+                if total <= self.max_size:
+                    break
+                doomed.append((digest, ))
+                total -= compress_size
+            connection.executemany(
+                "DELETE FROM blobs WHERE digest = ?", doomed
+            )
+            connection.executemany(
+                "DELETE FROM files WHERE digest = ?", doomed
+            )
+        for digest, in doomed:
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from functools import wraps
+
+import json
+import resource
+import time
+
+
+def max_rss(who=resource.RUSAGE_SELF):
+    """return the peak resident set size of this process in kilobytes
+
+    with `resource.RUSAGE_CHILDREN`, that of the largest of its finished
+    child processes.
+    """
+    return resource.getrusage(who).ru_maxrss
+
+
+def current_rss():
+    """return the resident set size of this process in kilobytes
+
+    or None where it cannot be read from /proc.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+class Metrics(object):
+    """collect stage timings and counters for the export of one article
+
+    For each timed stage the total wall-clock time, the number of calls and
+    the growth of peak process memory while in the stage are recorded.
+    Timed stages may be nested, in which case the time of the inner stage
+    is included in the outer one.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = {}
+        self.calls = {}
+        self.rss_growth = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        rss = max_rss()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.timings[stage] = self.timings.get(stage, 0) + elapsed
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+            growth = max_rss() - rss
+            self.rss_growth[stage] = self.rss_growth.get(stage, 0) + growth
+
+    def increment(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def as_dict(self, **extra):
+        record = {
+            'elapsed': time.time() - self.started,
+            'timings': self.timings,
+            'calls': self.calls,
+            'rss_growth_kb': self.rss_growth,
+            'peak_rss_kb': max_rss(),
+            'rss_kb': current_rss(),
+            'counters': self.counters,
+        }
+        record.update(extra)
+        return record
+
+    def write_record(self, path, **extra):
+        """append the metrics as a single line of JSON to the file at path"""
+        line = json.dumps(self.as_dict(**extra), sort_keys=True) + '\n'
+        # a single write of a whole line keeps records from concurrent
+        # export processes from interleaving
+        with open(path, 'a') as fh:
+            fh.write(line)
+
+
+def timed(stage):
+    """time calls to a method of an object with a `metrics` attribute"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from rcr_export_control import convert_export
+from rcr_export_control import export_article
+from rcr_export_control import init_worker
+from rcr_export_control import make_pubmed_client
+from rcr_export_control import make_rate_limiter
+from rcr_export_control import record_metrics
+from rcr_export_control import CONVERSIONS_PER_PROCESS
+from rcr_export_control.exporters import make_exporters
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.utils import ExportSource
+from rcr_export_control.xml_tools import scan_pubmed_ids
+from subprocess import CalledProcessError
+
+import Queue
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import traceback
+
+
+DEFAULT_LOOKUP_JOBS = 2
+
+# tells the threads of a stage that no more work will come
+_DONE = object()
+
+
+class Stage(object):
+    """a number of threads taking work from a bounded inbox
+
+    `handle` is called with each item put to the stage.  Once the inbox is
+    full, putting an item blocks until a thread takes one, so a fast stage
+    can never run further ahead of a slow one than the size of its inbox.
+    """
+
+    def __init__(self, handle, threads, size=None):
+        self.handle = handle
+        self.inbox = Queue.Queue(maxsize=size or threads)
+        self.threads = []
+        for index in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def close(self):
+        """wait for all work put to the stage to be handled"""
+        for thread in self.threads:
+            self.inbox.put(_DONE)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                return
+            self.handle(item)
+
+
+class ExportPipeline(object):
+    """export and archive articles in overlapping stages
+
+    each article is exported via PHP by one of `export_jobs` threads, has
+    the PubMed summaries of its references fetched by one of `lookup_jobs`
+    threads, then is converted and archived in one of `convert_jobs` worker
+    processes, so the export of one article, the reference lookup of the
+    next and the conversion of a third all run at once.
+
+    Each stage holds no more articles waiting than it has workers, so the
+    number of exports on disk stays bounded however many articles are
+    given.  Exports streamed from PHP are read by the conversion process as
+    they are written, so they skip the reference lookup stage.  Conversion
+    processes are reused for `CONVERSIONS_PER_PROCESS` articles.
+
+    When exporting incrementally, `get_previous` is called with the id of
+    each article for its manifest entry, which is sent along with it.
+    """
+
+    def __init__(
+        self, settings, convert_jobs=1, export_jobs=None,
+        lookup_jobs=DEFAULT_LOOKUP_JOBS, exporters=None, get_previous=None,
+    ):
+        self.settings = settings
+        self.get_previous = get_previous
+        export_jobs = export_jobs or convert_jobs
+        if exporters is None:
+            exporters = make_exporters(settings, export_jobs)
+        self.exporters = Queue.Queue()
+        for exporter in exporters:
+            self.exporters.put(exporter)
+        rate_limiter = make_rate_limiter(settings, shared=True)
+        init_worker(rate_limiter)
+        self.pool = multiprocessing.Pool(
+            convert_jobs,
+            initializer=init_worker,
+            initargs=(rate_limiter, True, settings['schema_path']),
+            maxtasksperchild=CONVERSIONS_PER_PROCESS,
+        )
+        self.results = Queue.Queue()
+        self.local = threading.local()
+        self.convert_stage = Stage(self._convert, convert_jobs)
+        self.lookup_stage = Stage(self._look_up, lookup_jobs)
+        self.export_stage = Stage(self._export, export_jobs)
+
+    def run(self, articleids):
+        """export each article, yielding results as in `export_article`
+
+        results are yielded in the order articles finish.  `articleids` may
+        be any iterable, it is consumed no faster than articles are exported.
+        An error raised by it is raised again once the articles taken from
+        it before have been exported.
+        """
+        self.feed_error = None
+        feeder = threading.Thread(target=self._feed, args=(articleids, ))
+        feeder.daemon = True
+        feeder.start()
+        while True:
+            result = self.results.get()
+            if result is _DONE:
+                break
+            yield result
+        feeder.join()
+        if self.feed_error is not None:
+            raise self.feed_error[0], self.feed_error[1], self.feed_error[2]
+
+    def close(self):
+        # pool workers hold copies of the pipes to persistent exporters, so
+        # they must be gone before the exporters can be closed
+        self.pool.close()
+        self.pool.join()
+        while not self.exporters.empty():
+            self.exporters.get().close()
+
+    def _feed(self, articleids):
+        try:
+            for articleid in articleids:
+                self.export_stage.put(articleid)
+        except Exception:
+            self.feed_error = sys.exc_info()
+        finally:
+            self.export_stage.close()
+            self.lookup_stage.close()
+            self.convert_stage.close()
+            self.results.put(_DONE)
+
+    def _export(self, articleid):
+        """export an article via PHP to a temporary file"""
+        if self.settings['stream']:
+            # the process converting a streamed export runs PHP itself, so
+            # no fifo is ever open in this process as pool workers fork
+            self.convert_stage.put((articleid, None, None, None))
+            return
+
+        metrics = Metrics()
+        tmp_xml_path = None
+        try:
+            tmp_xml_fh, tmp_xml_path = tempfile.mkstemp(suffix=".xml")
+            os.close(tmp_xml_fh)
+            exporter = self.exporters.get()
+            try:
+                with metrics.timer('php_export'):
+                    exporter.export(articleid, tmp_xml_path)
+            finally:
+                self.exporters.put(exporter)
+        except Exception, e:
+            if tmp_xml_path is not None:
+                os.unlink(tmp_xml_path)
+            if isinstance(e, CalledProcessError):
+                error = "export failed: {0}".format(e.output)
+            else:
+                error = "export failed:\n{0}".format(traceback.format_exc())
+            record_metrics(self.settings, metrics, articleid, error=error)
+            self.results.put((articleid, error, None, None))
+            return
+        source = ExportSource(path=tmp_xml_path)
+        self.lookup_stage.put((articleid, source, metrics))
+
+    def _look_up(self, item):
+        """fetch the PubMed summaries of the references of an export
+
+        a failed lookup is not an error here, the conversion will try again
+        and report it.
+        """
+        articleid, source, metrics = item
+        prefetched = None
+        try:
+            with metrics.timer('pubmed_prefetch'):
+                with source.open() as fh:
+                    pmids = scan_pubmed_ids(fh)
+                if pmids:
+                    client = self._get_pubmed_client()
+                    prefetched = (
+                        client.get_summaries(pmids), client.db_build
+                    )
+        except Exception:
+            pass
+        self.convert_stage.put((articleid, source, metrics, prefetched))
+
+    def _convert(self, item):
+        """convert and archive an export in a pool process"""
+        articleid, source, metrics, prefetched = item
+        previous = None
+        if self.get_previous is not None:
+            previous = self.get_previous(articleid)
+        if source is None:
+            function = export_article
+            task = (articleid, self.settings, previous)
+        else:
+            function = convert_export
+            task = (
+                articleid, source, self.settings, metrics, prefetched,
+                previous,
+            )
+        try:
+            result = self.pool.apply(function, (task, ))
+        except Exception:
+            error = "archiving failed:\n{0}".format(traceback.format_exc())
+            result = (articleid, error, None, None)
+        finally:
+            if source is not None:
+                source.discard()
+        self.results.put(result)
+
+    def _get_pubmed_client(self):
+        # a cache connection may only be used by the thread which opened it
+        client = getattr(self.local, 'pubmed_client', None)
+        if client is None:
+            client = self.local.pubmed_client = make_pubmed_client(
+                self.settings
+            )
+        return client
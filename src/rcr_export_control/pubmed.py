@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from contextlib import closing
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+import multiprocessing
+import requests
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_TTL = 90 * 24 * 60 * 60           # 90 days, in seconds
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024          # 256 MB of summary xml
+# sqlite refuses statements with more than 999 bound parameters
+SQLITE_MAX_VARIABLES = 999
+
+ESUMMARY_URL = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
+ESEARCH_URL = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+# the PubMed search field of each kind of id resolved to a PMID
+SEARCH_FIELDS = {'pmcid': 'pmcid', 'doi': 'doi'}
+# NCBI permits 3 requests per second, or 10 when using an api key
+NCBI_REQUEST_RATE = 3
+NCBI_API_KEY_REQUEST_RATE = 10
+MAX_IDS_PER_REQUEST = 200
+# NCBI asks that long lists of ids be sent by POST rather than GET
+POST_THRESHOLD = 100
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5                             # seconds, doubled per retry
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = 60
+MEMO_SIZE = 10000
+
+CREATE_SUMMARY_TABLE = """
+CREATE TABLE IF NOT EXISTS summaries (
+    pmid TEXT PRIMARY KEY,
+    summary BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL
+)
+"""
+# the PMIDs of other ids, like DOIs, or NULL where PubMed has none
+CREATE_IDENTIFIER_TABLE = """
+CREATE TABLE IF NOT EXISTS identifiers (
+    identifier TEXT PRIMARY KEY,
+    pmid TEXT,
+    resolved REAL NOT NULL
+)
+"""
+
+
+def chunked(items, size):
+    """yield successive lists of at most `size` items from `items`
+
+    >>> list(chunked(['1', '2', '3'], 2))
+    [['1', '2'], ['3']]
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class PubMedCache(object):
+    """persistent on-disk store of PubMed esummary DocumentSummary records
+
+    Summaries are stored as serialized xml keyed by PMID in an sqlite
+    database, so the cache may be shared by several export processes.
+    Entries older than `ttl` seconds are treated as missing, and once the
+    stored summaries exceed `max_size` bytes the least recently used entries
+    are evicted.  The PMIDs other ids resolve to are kept alongside, see
+    `PubMedClient.resolve`.
+    """
+
+    def __init__(
+        self, path, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_SIZE
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        # connect lazily, so that a cache may be configured in one process
+        # and used in another.  An sqlite connection must not be used by two
+        # threads at once, so each thread has its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            connection.text_factory = str
+            connection.execute(CREATE_SUMMARY_TABLE)
+            connection.execute(CREATE_IDENTIFIER_TABLE)
+            connection.commit()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def get_many(self, pmids):
+        """return a dict of cached summary xml for `pmids`, keyed by pmid
+
+        expired and missing summaries are not included in the result.
+        """
+        found = {}
+        now = time.time()
+        oldest = now - self.ttl
+        unique = set(pmids)
+        with self.connection as connection:
+            for chunk in chunked(unique, SQLITE_MAX_VARIABLES - 1):
+                marks = ','.join('?' * len(chunk))
+                query = "SELECT pmid, summary FROM summaries "
+                query += "WHERE pmid IN ({0}) AND fetched >= ?".format(marks)
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute(query, chunk + [oldest])
+                    for pmid, summary in cursor.fetchall():
+                        found[pmid] = bytes(summary)
+            for chunk in chunked(found, SQLITE_MAX_VARIABLES - 1):
+                marks = ','.join('?' * len(chunk))
+                query = "UPDATE summaries SET accessed = ? "
+                query += "WHERE pmid IN ({0})".format(marks)
+                connection.execute(query, [now] + chunk)
+        return found
+
+    def set_many(self, summaries):
+        """store a dict of summary xml keyed by pmid"""
+        if not summaries:
+            return
+        now = time.time()
+        rows = [
+            (pmid, sqlite3.Binary(summary), len(summary), now, now)
+            for pmid, summary in summaries.items()
+        ]
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)", rows
+            )
+        self.evict()
+
+    def get_pmids(self, identifiers):
+        """return a dict of the cached PMIDs of `identifiers`
+
+        the PMID of an identifier PubMed does not know is None.  Expired
+        and missing identifiers are not included in the result.
+        """
+        found = {}
+        oldest = time.time() - self.ttl
+        with self.connection as connection:
+            for chunk in chunked(set(identifiers), SQLITE_MAX_VARIABLES - 1):
+                marks = ','.join('?' * len(chunk))
+                query = "SELECT identifier, pmid FROM identifiers "
+                query += "WHERE identifier IN ({0}) ".format(marks)
+                query += "AND resolved >= ?"
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute(query, chunk + [oldest])
+                    found.update(cursor.fetchall())
+        return found
+
+    def set_pmids(self, pmids):
+        """store a dict of PMIDs, or None, keyed by identifier"""
+        if not pmids:
+            return
+        now = time.time()
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?)",
+                [(identifier, pmid, now) for identifier, pmid in pmids.items()]
+            )
+
+    def evict(self):
+        """drop least recently used summaries until within `max_size`"""
+        with self.connection as connection:
+            total = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM summaries"
+            ).fetchone()[0]
+            if total <= self.max_size:
+                return
+            rows = connection.execute(
+                "SELECT pmid, size FROM summaries ORDER BY accessed"
+            ).fetchall()
+            doomed = []
+            for pmid, size in rows:
+                if total <= self.max_size:
+                    break
+                doomed.append((pmid, ))
+                total -= size
+            connection.executemany(
+                "DELETE FROM summaries WHERE pmid = ?", doomed
+            )
+
+
+class PubMedError(IOError):
+    pass
+
+
+class RateLimiter(object):
+    """token bucket limiting callers to `rate` acquisitions per second
+
+    Up to `burst` acquisitions may be made at once after an idle period. If
+    `shared` is true, the bucket lives in shared memory and limits all
+    processes forked after it is created, such as multiprocessing workers.
+    """
+
+    def __init__(self, rate, burst=1, shared=False):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        if shared:
+            # [available tokens, time of last refill]
+            self._state = multiprocessing.Array('d', [self.burst, 0.0])
+            self._lock = self._state.get_lock()
+        else:
+            self._state = [self.burst, 0.0]
+            self._lock = threading.Lock()
+
+    def acquire(self):
+        """take a token from the bucket, sleeping until one is available"""
+        while True:
+            with self._lock:
+                now = time.time()
+                tokens, refilled = self._state[0], self._state[1]
+                tokens = min(self.burst, tokens + (now - refilled) * self.rate)
+                if tokens >= 1:
+                    self._state[0] = tokens - 1
+                    self._state[1] = now
+                    return
+                self._state[0] = tokens
+                self._state[1] = now
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+class PubMedClient(object):
+    """fetch PubMed esummary DocumentSummary records for lists of PMIDs
+
+    Requests share a pooled http session and are limited by `rate_limiter`.
+    Long id lists are split into chunks of at most `chunk_size` ids, and the
+    chunk responses are merged into a single eSummaryResult.  Failed requests
+    are retried with exponential backoff.  If a `cache` is given, it is
+    consulted before any request is made.  An `offline` client makes no
+    requests at all, ids it has neither cached nor fetched before are given
+    error summaries.
+
+    A client may be shared by several threads; ids requested by more than
+    one thread at a time are only fetched once.
+    """
+
+    base_url = ESUMMARY_URL
+    search_url = ESEARCH_URL
+    base_query = {
+        'db': 'pubmed',
+        'version': '2.0',
+    }
+
+    def __init__(
+        self,
+        cache=None,
+        rate_limiter=None,
+        api_key=None,
+        chunk_size=MAX_IDS_PER_REQUEST,
+        post_threshold=POST_THRESHOLD,
+        retries=MAX_RETRIES,
+        backoff=RETRY_BACKOFF,
+        session=None,
+        offline=False,
+    ):
+        self.cache = cache
+        self.offline = offline
+        if rate_limiter is None:
+            rate = NCBI_API_KEY_REQUEST_RATE if api_key else NCBI_REQUEST_RATE
+            rate_limiter = RateLimiter(rate)
+        self.rate_limiter = rate_limiter
+        self.api_key = api_key
+        self.chunk_size = chunk_size
+        self.post_threshold = post_threshold
+        self.retries = retries
+        self.backoff = backoff
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=10))
+            session.mount('https://', HTTPAdapter(pool_maxsize=10))
+        self.session = session
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._memo = OrderedDict()
+        self._resolved = {}
+        self._db_build = None
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    @property
+    def db_build(self):
+        """the PubMed build named by the first response received"""
+        return self._db_build
+
+    def preload(self, summaries, db_build=None):
+        """remember summaries fetched elsewhere, as by another process"""
+        with self._lock:
+            self._memo.update(summaries)
+            while len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+            if self._db_build is None:
+                self._db_build = db_build
+
+    def summarize(self, ids):
+        """return an eSummaryResult element with a summary for each id
+
+        The summaries are placed in the DocumentSummarySet in the order of
+        `ids`, following a DbBuild element. An id for which PubMed returned
+        nothing at all is given a DocumentSummary holding an error element.
+        """
+        found = self.get_summaries(ids)
+        source = etree.Element('eSummaryResult')
+        container = etree.SubElement(source, 'DocumentSummarySet')
+        db_build = etree.SubElement(container, 'DbBuild')
+        db_build.text = self._db_build
+        for pmid in ids:
+            if pmid in found:
+                summary = etree.XML(found[pmid])
+            else:
+                summary = etree.Element('DocumentSummary', uid=pmid)
+                etree.SubElement(summary, 'error')
+            container.append(summary)
+        return source
+
+    def get_summaries(self, ids):
+        """return a dict of DocumentSummary xml for `ids`, keyed by pmid"""
+        found = {}
+        if self.cache is not None:
+            found.update(self.cache.get_many(ids))
+        wanted = [pmid for pmid in unique(ids) if pmid not in found]
+        if not wanted:
+            return found
+        if self.offline:
+            with self._lock:
+                for pmid in wanted:
+                    if pmid in self._memo:
+                        found[pmid] = self._memo[pmid]
+            return found
+
+        # claim the ids no other thread is fetching, and note the ones that
+        # are already on their way
+        with self._lock:
+            mine = []
+            theirs = []
+            for pmid in wanted:
+                if pmid in self._memo:
+                    found[pmid] = self._memo[pmid]
+                elif pmid in self._pending:
+                    theirs.append(self._pending[pmid])
+                else:
+                    self._pending[pmid] = threading.Event()
+                    mine.append(pmid)
+        try:
+            fetched = self._fetch(mine)
+        finally:
+            with self._lock:
+                for pmid in mine:
+                    self._pending.pop(pmid).set()
+        found.update(fetched)
+        for event in theirs:
+            event.wait()
+
+        # anything still missing was claimed by a thread whose request failed
+        with self._lock:
+            for pmid in wanted:
+                if pmid not in found and pmid in self._memo:
+                    found[pmid] = self._memo[pmid]
+        missing = [pmid for pmid in wanted if pmid not in found]
+        if missing:
+            found.update(self._fetch(missing))
+        return found
+
+    def resolve(self, ids):
+        """return a dict of the PMIDs of (kind, id) tuples, keyed by them
+
+        kinds are 'pmcid' and 'doi', looked up by a PubMed search for each.
+        The PMID of an id PubMed does not know is None.  An offline client
+        leaves out the ids it has neither cached nor resolved before.
+        """
+        found = {}
+        keys = {}
+        for kind, value in unique(ids):
+            keys['{0}:{1}'.format(kind, value)] = (kind, value)
+        cached = {}
+        if self.cache is not None:
+            cached.update(self.cache.get_pmids(keys))
+        with self._lock:
+            for key in keys:
+                if key not in cached and key in self._resolved:
+                    cached[key] = self._resolved[key]
+        resolved = {}
+        for key, (kind, value) in sorted(keys.items()):
+            if key in cached:
+                found[kind, value] = cached[key]
+            elif not self.offline:
+                pmid = self._search(
+                    '"{0}"[{1}]'.format(value, SEARCH_FIELDS[kind])
+                )
+                found[kind, value] = resolved[key] = pmid
+        if self.cache is not None:
+            self.cache.set_pmids(resolved)
+        with self._lock:
+            if len(self._resolved) > MEMO_SIZE:
+                self._resolved.clear()
+            self._resolved.update(resolved)
+            self._resolved.update(cached)
+        return found
+
+    def _search(self, term):
+        """return the PMID of the only article found by a search, or None"""
+        query = {'db': 'pubmed', 'term': term}
+        result = self._call(self.search_url, query, "PubMed search")
+        ids = [node.text for node in result.iterfind('.//IdList/Id')]
+        if len(ids) == 1:
+            return ids[0]
+        return None
+
+    def _fetch(self, ids):
+        """request summaries for ids from PubMed in bounded chunks"""
+        fetched = {}
+        for chunk in chunked(ids, self.chunk_size):
+            result = self._request(chunk)
+            db_build = result.find('.//DbBuild')
+            if db_build is not None and self._db_build is None:
+                self._db_build = db_build.text
+            for summary in result.iterfind('.//DocumentSummary'):
+                fetched[summary.attrib.get('uid')] = etree.tostring(summary)
+        if self.cache is not None:
+            # never cache the errors pubmed reports for bad ids
+            self.cache.set_many(dict(
+                (pmid, summary) for pmid, summary in fetched.items()
+                if not is_error_summary(summary)
+            ))
+        with self._lock:
+            self._memo.update(fetched)
+            while len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return fetched
+
+    def _request(self, ids):
+        """make one rate limited, retried esummary request for ids"""
+        query = {'id': ','.join(ids)}
+        query.update(self.base_query)
+        return self._call(
+            self.base_url, query,
+            "PubMed lookup of {0} ids".format(len(ids)),
+            post=len(ids) > self.post_threshold,
+        )
+
+    def _call(self, url, query, description, post=False):
+        """make a rate limited, retried request, returning the xml answer"""
+        if self.api_key:
+            query['api_key'] = self.api_key
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            error = None
+            try:
+                if post:
+                    resp = self.session.post(
+                        url, data=query, timeout=REQUEST_TIMEOUT
+                    )
+                else:
+                    resp = self.session.get(
+                        url, params=query, timeout=REQUEST_TIMEOUT
+                    )
+            except requests.RequestException, e:
+                error = str(e)
+            else:
+                if resp.ok:
+                    # must pass a byte-string to the parser
+                    return etree.XML(resp.content)
+                error = "HTTP status {0}".format(resp.status_code)
+                if resp.status_code not in RETRY_STATUS_CODES:
+                    break
+            if attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+        raise PubMedError("{0} failed: {1}".format(description, error))
+
+
+def unique(items):
+    """return the distinct members of `items`, in order
+
+    >>> unique(['2', '1', '2'])
+    ['2', '1']
+    """
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def is_error_summary(summary):
+    """determine if DocumentSummary xml reports an error for its id"""
+    return etree.XML(summary).find('error') is not None
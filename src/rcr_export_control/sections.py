@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""the JATS section types of article headings
+
+headings are normalized before they are looked up, so 'Case Report:',
+'CASE-REPORT' and 'case  report' are all the same heading.  A heading not
+found as it is matches the closest known heading, if one is close enough,
+like 'Conclusion' for 'conclusions'.  Headings may be added or overridden
+by a mapping file, a JSON object of headings and their section types, where
+a section type of null gives a heading no section type at all.
+"""
+from argparse import ArgumentTypeError
+from rcr_export_control import constants
+
+import difflib
+import json
+import re
+
+
+# runs of anything but letters and digits separate the words of a heading
+SEPARATOR_PAT = re.compile(r'[\W_]+', re.U)
+# the least similarity of a heading and the known heading it is taken for
+FUZZY_CUTOFF = 0.85
+
+
+def normalize_heading(heading):
+    """return a heading in lower case, with words separated by single spaces
+
+    >>> normalize_heading(u' Methods & Materials: ')
+    u'methods and materials'
+    >>> normalize_heading('supplementary-material')
+    u'supplementary material'
+    """
+    if isinstance(heading, str):
+        heading = heading.decode('utf-8', 'replace')
+    heading = heading.lower().replace(u'&', u' and ')
+    return SEPARATOR_PAT.sub(u' ', heading).strip()
+
+
+def load_section_mapping(path):
+    """read a mapping file of headings and section types
+
+    raises ValueError if the file does not hold a JSON object of strings.
+    """
+    with open(path) as fh:
+        mapping = json.load(fh)
+    if not isinstance(mapping, dict):
+        raise ValueError("expected a JSON object of headings")
+    for heading, sec_type in mapping.items():
+        if sec_type is not None and not isinstance(sec_type, basestring):
+            raise ValueError(
+                "section type of {0!r} is not a string".format(heading)
+            )
+    return mapping
+
+
+def parse_section_mapping(value):
+    """load a mapping file given on the command line"""
+    try:
+        return load_section_mapping(value)
+    except (IOError, ValueError), e:
+        raise ArgumentTypeError(
+            "invalid section mapping {0!r}: {1}".format(value, e)
+        )
+
+
+class SectionTypes(object):
+    """lookup table of the section types of normalized headings
+
+    built once from the JATS section types and RCR headings of `constants`,
+    updated by `mapping`, a dict of headings and section types.  Fuzzy
+    matches are remembered, so each distinct heading is matched once.
+    """
+
+    def __init__(self, mapping=None, cutoff=FUZZY_CUTOFF):
+        self.cutoff = cutoff
+        self.table = {}
+        for sec_type in constants.JATS_SEC_TYPES:
+            self.table[normalize_heading(sec_type)] = sec_type
+        for heading, sec_type in constants.RCR_TO_JATS_SEC_MAPPING.items():
+            self.table[normalize_heading(heading)] = sec_type
+        for heading, sec_type in (mapping or {}).items():
+            self.table[normalize_heading(heading)] = sec_type
+        self.known = list(self.table)
+        self.fuzzy = {}
+
+    def lookup(self, heading):
+        """return the section type of a heading, or None
+
+        >>> types = SectionTypes({'Teaching Point': 'conclusions'})
+        >>> types.lookup('Case Report:'), types.lookup('Conclusion')
+        ('cases', 'conclusions')
+        >>> types.lookup('TEACHING POINT'), types.lookup('Imaging Findings')
+        ('conclusions', None)
+        """
+        heading = normalize_heading(heading)
+        try:
+            return self.table[heading]
+        except KeyError:
+            pass
+        try:
+            return self.fuzzy[heading]
+        except KeyError:
+            pass
+        matches = difflib.get_close_matches(
+            heading, self.known, n=1, cutoff=self.cutoff
+        )
+        sec_type = None
+        if matches:
+            sec_type = self.table[matches[0]]
+        self.fuzzy[heading] = sec_type
+        return sec_type
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from collections import OrderedDict
+from rcr_export_control import build_archive
+from rcr_export_control import init_worker
+from rcr_export_control import make_pubmed_client
+from rcr_export_control import make_rate_limiter
+from rcr_export_control import make_settings
+from rcr_export_control import make_worker_command
+from rcr_export_control import options
+from rcr_export_control import CONVERSIONS_PER_PROCESS
+from rcr_export_control.exporters import make_exporters
+from rcr_export_control.log import configure_logging
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.utils import ExportSource
+from SocketServer import ThreadingMixIn
+from SocketServer import UnixStreamServer
+from multiprocessing.util import Finalize
+from subprocess import CalledProcessError
+
+import Queue
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8787
+# finished jobs are forgotten, oldest first, beyond this number
+MAX_FINISHED_JOBS = 1000
+
+# the states of an export job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DESCRIPTION = """
+Run a local export service. Article ids posted to the service are queued and
+exported by long running workers, so the cost of starting PHP and Python is
+not paid for every article.
+
+    POST /exports       {"ids": [793, 794], "wait": false}
+    GET  /exports       all known jobs
+    GET  /exports/<job> the status of one job, with its archive path
+    GET  /status        the number of queued and running jobs
+
+With "wait": true, the POST returns once all of its jobs have finished.
+"""
+
+# the PubMed client of a pool process, kept for all the articles it converts
+_pubmed_client = None
+
+
+def init_converter(rate_limiter, settings):
+    """set up a pool process converting articles for the service
+
+    the process keeps one PubMed client, so its http connections and the
+    summaries it has looked up are reused by every article it converts.
+    The client is closed as the process exits.
+    """
+    global _pubmed_client
+    init_worker(rate_limiter, True, settings['schema_path'])
+    _pubmed_client = make_pubmed_client(settings)
+    Finalize(None, _pubmed_client.close, exitpriority=10)
+
+
+def convert_article(task):
+    """convert exported xml and build its archive in a pool process
+
+    returns a tuple of (archive_path, metrics, error), where error is None
+    on success and a traceback otherwise.
+    """
+    articleid, xml_path, settings = task
+    metrics = Metrics()
+    try:
+        archive_path = build_archive(
+            articleid, ExportSource(path=xml_path), settings, _pubmed_client,
+            metrics
+        )
+        return archive_path, metrics, None
+    except Exception:
+        return None, metrics, traceback.format_exc()
+
+
+class ExportJob(object):
+    """the export of one article by an ExportService"""
+
+    def __init__(self, job_id, articleid):
+        self.id = job_id
+        self.articleid = articleid
+        self.status = QUEUED
+        self.archive = None
+        self.error = None
+        self.metrics = None
+        self.submitted = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'article': self.articleid,
+            'status': self.status,
+            'archive': self.archive,
+            'error': self.error,
+            'metrics': self.metrics,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+
+class ExportService(object):
+    """a queue of article exports worked by long running workers
+
+    each of `jobs` threads takes the next job from the queue, exports the
+    article through one of `exporters`, then has it converted and archived
+    in a process of a pool forked from this one, so imported modules are
+    warm and the PubMed cache and rate limit are shared by all jobs.
+
+    Pool processes, and the PubMed client each keeps, are reused for
+    `CONVERSIONS_PER_PROCESS` articles.  Closing the service closes them.
+    """
+
+    def __init__(self, settings, exporters, jobs=1):
+        self.settings = settings
+        self.queue = Queue.Queue()
+        self.exporters = Queue.Queue()
+        for exporter in exporters:
+            self.exporters.put(exporter)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.pool = multiprocessing.Pool(
+            jobs,
+            initializer=init_converter,
+            initargs=(make_rate_limiter(settings, shared=True), settings),
+            maxtasksperchild=CONVERSIONS_PER_PROCESS,
+        )
+        self.threads = []
+        for index in range(jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, articleids):
+        """queue an export job for each article id and return the jobs"""
+        jobs = []
+        with self.lock:
+            for articleid in articleids:
+                job = ExportJob(str(next(self.job_ids)), articleid)
+                self.jobs[job.id] = job
+                jobs.append(job)
+            self._forget_finished()
+        for job in jobs:
+            self.queue.put(job)
+        return jobs
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self):
+        counts = dict.fromkeys([QUEUED, RUNNING, DONE, FAILED], 0)
+        for job in self.list():
+            counts[job.status] += 1
+        return counts
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pool.close()
+        self.pool.join()
+        while not self.exporters.empty():
+            self.exporters.get().close()
+
+    def _forget_finished(self):
+        finished = [
+            job_id for job_id, job in self.jobs.items() if job.done.is_set()
+        ]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.status = RUNNING
+            try:
+                self._run(job)
+            except Exception:
+                job.error = traceback.format_exc()
+            job.status = FAILED if job.error else DONE
+            job.finished = time.time()
+            job.done.set()
+            if job.error:
+                print "Article {0} failed: {1}\n".format(
+                    job.articleid, job.error
+                )
+            else:
+                print "Article {0} archived\n".format(job.articleid)
+
+    def _run(self, job):
+        tmp_xml_fh, tmp_xml_path = tempfile.mkstemp(suffix=".xml")
+        os.close(tmp_xml_fh)
+        try:
+            exporter = self.exporters.get()
+            started = time.time()
+            try:
+                exporter.export(job.articleid, tmp_xml_path)
+            except CalledProcessError, e:
+                job.error = "export failed: {0}".format(e.output)
+                return
+            finally:
+                self.exporters.put(exporter)
+            php_export = time.time() - started
+
+            task = (job.articleid, tmp_xml_path, self.settings)
+            archive_path, metrics, error = self.pool.apply(
+                convert_article, (task, )
+            )
+        finally:
+            os.unlink(tmp_xml_path)
+
+        metrics.timings['php_export'] = php_export
+        metrics.calls['php_export'] = 1
+        if error is not None:
+            job.error = "archiving failed:\n{0}".format(error)
+        job.archive = archive_path
+        job.metrics = metrics.as_dict()
+        if self.settings['profile']:
+            metrics.write_record(
+                self.settings['profile'],
+                article=job.articleid,
+                archive=archive_path,
+                failed=error is not None,
+            )
+
+
+class ExportRequestHandler(BaseHTTPRequestHandler):
+    """json api to the ExportService of the server"""
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == '/status':
+            self._respond(200, service.status())
+        elif path == '/exports':
+            self._respond(
+                200, {'jobs': [job.as_dict() for job in service.list()]}
+            )
+        elif path.startswith('/exports/'):
+            job = service.get(path[len('/exports/'):])
+            if job is None:
+                self._respond(404, {'error': 'no such job'})
+            else:
+                self._respond(200, job.as_dict())
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path != '/exports':
+            self._respond(404, {'error': 'not found'})
+            return
+
+        length = int(self.headers.getheader('content-length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or '{}')
+            articleids = [int(articleid) for articleid in body['ids']]
+        except (ValueError, KeyError, TypeError):
+            self._respond(400, {'error': 'expected {"ids": [ID, ...]}'})
+            return
+
+        jobs = self.server.service.submit(articleids)
+        if body.get('wait'):
+            for job in jobs:
+                job.done.wait()
+            status = 200
+        else:
+            status = 202
+        self._respond(status, {'jobs': [job.as_dict() for job in jobs]})
+
+    def address_string(self):
+        # clients of a unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        # the base class reads client_address[0] itself, which fails for
+        # clients of a unix socket
+        if not self.server.quiet:
+            sys.stderr.write("%s - - [%s] %s\n" % (
+                self.address_string(), self.log_date_time_string(),
+                format % args
+            ))
+
+    def _respond(self, status, content):
+        body = json.dumps(content, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+parser = ArgumentParser(
+    prog='rcrexport serve',
+    description=DESCRIPTION,
+    parents=[options])
+parser.add_argument(
+    '--host',
+    default=DEFAULT_HOST,
+    help="Address to listen on (defaults to {0})".format(DEFAULT_HOST),
+)
+parser.add_argument(
+    '--port',
+    type=int,
+    default=DEFAULT_PORT,
+    help="Port to listen on (defaults to {0})".format(DEFAULT_PORT),
+)
+parser.add_argument(
+    '--socket',
+    metavar="/path/to/socket",
+    help="Listen on this unix socket instead of a tcp port",
+)
+
+
+def make_server(arguments, service):
+    if arguments.socket:
+        if os.path.exists(arguments.socket):
+            os.remove(arguments.socket)
+        server = ThreadingUnixHTTPServer(
+            arguments.socket, ExportRequestHandler
+        )
+    else:
+        server = ThreadingHTTPServer(
+            (arguments.host, arguments.port), ExportRequestHandler
+        )
+    server.service = service
+    server.quiet = bool(arguments.quiet)
+    return server
+
+
+def main(argv=None):
+    arguments = parser.parse_args(argv)
+    settings = make_settings(arguments, php_required=not arguments.php_worker)
+    configure_logging(
+        arguments.quiet, arguments.log_level, arguments.log_file,
+        arguments.log_json,
+    )
+    jobs = max(1, arguments.jobs)
+    exporters = make_exporters(
+        settings, jobs, make_worker_command(arguments, settings)
+    )
+
+    service = ExportService(settings, exporters, jobs)
+    server = make_server(arguments, service)
+    print "Serving exports on {0}\n".format(
+        arguments.socket or '{0}:{1}'.format(*server.server_address)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if arguments.socket and os.path.exists(arguments.socket):
+            os.remove(arguments.socket)
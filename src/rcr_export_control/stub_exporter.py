@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""a stand-in for a persistent PHP export worker
+
+speaks the line protocol of `exporters.PersistentExporter`, answering each
+request with a synthetic export from `benchmark.make_export_xml`, as the
+bundled export_worker.php does with real ones, so that `rcrexport serve` can
+be run and tested without an RCR installation:
+
+    $ rcrexport serve /path/to/rcr \\
+        --php-worker "python -m rcr_export_control.stub_exporter /tmp/files"
+
+the exports cite no references by default, so no PubMed lookups are made.
+"""
+from argparse import ArgumentParser
+from rcr_export_control.benchmark import make_export_xml
+
+import sys
+import time
+
+
+parser = ArgumentParser(description="Stub persistent export worker")
+parser.add_argument(
+    'files_dir',
+    metavar="/path/to/files",
+    help="Directory in which the files referred to by exports are written",
+)
+parser.add_argument('--references', type=int, default=0,
+                    help="Number of PubMed linked references (default 0)")
+parser.add_argument('--delay', type=float, default=0,
+                    help="Simulated export time in seconds (default 0)")
+
+
+def main(argv=None):
+    arguments = parser.parse_args(argv)
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            articleid, path = line.split(None, 1)
+            export = make_export_xml(
+                arguments.files_dir,
+                article_id=int(articleid),
+                references=arguments.references,
+                seed=int(articleid),
+            )
+            time.sleep(arguments.delay)
+            with open(path.strip(), 'w') as fh:
+                fh.write(export)
+        except Exception, e:
+            reply = 'error {0}'.format(str(e).replace('\n', ' '))
+        else:
+            reply = 'ok'
+        sys.stdout.write(reply + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
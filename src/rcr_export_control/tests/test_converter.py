@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+from rcr_export_control.benchmark import make_export_xml
+from rcr_export_control.benchmark import make_stub_client
+from rcr_export_control.htmltree import HTML_ENGINES
+from rcr_export_control.utils import ArticleConverter
+from StringIO import StringIO
+
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+
+
+def read_archive(path):
+    """return the content of each file in an archive, keyed by name"""
+    with zipfile.ZipFile(path) as archive:
+        return dict(
+            (name, archive.read(name)) for name in archive.namelist()
+        )
+
+
+def figure_ids(content):
+    """return the ids of the figures of an archive and the figure xrefs"""
+    for name, data in content.items():
+        if name.endswith('.xml'):
+            tree = etree.XML(data)
+            return (
+                [fig.get('id') for fig in tree.iter('fig')],
+                [xref.get('rid') for xref in tree.iter('xref')
+                 if xref.get('ref-type') == 'fig'],
+            )
+
+
+class ConverterIndependenceTests(unittest.TestCase):
+    """articles converted by one converter are archived as if alone"""
+
+    def setUp(self):
+        self.directories = []
+        files_dir = self.make_directory()
+        # articles with different numbers of figures, references and media
+        self.exports = [
+            make_export_xml(
+                files_dir, article_id=1, figures=2, malformed_figures=1,
+                references=6, media_links=1, file_size=1024, seed=1,
+            ),
+            make_export_xml(
+                files_dir, article_id=2, figures=4, malformed_figures=0,
+                references=9, media_links=2, file_size=1024, seed=2,
+            ),
+        ]
+
+    def tearDown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def make_directory(self):
+        directory = tempfile.mkdtemp()
+        self.directories.append(directory)
+        return directory
+
+    def make_converter(self, html_engine):
+        return ArticleConverter(
+            self.make_directory(), make_stub_client(), html_engine
+        )
+
+    def convert(self, converter, export):
+        return read_archive(converter.convert(StringIO(export)))
+
+    def convert_alone(self, html_engine):
+        return [
+            self.convert(self.make_converter(html_engine), export)
+            for export in self.exports
+        ]
+
+    def assertSameArchives(self, archives, alone):
+        for content, expected in zip(archives, alone):
+            self.assertEqual(figure_ids(content), figure_ids(expected))
+            self.assertEqual(sorted(content), sorted(expected))
+            self.assertEqual(content, expected)
+
+    def test_sequential(self):
+        for html_engine in HTML_ENGINES:
+            alone = self.convert_alone(html_engine)
+            converter = self.make_converter(html_engine)
+            archives = [
+                self.convert(converter, export) for export in self.exports
+            ]
+            self.assertSameArchives(archives, alone)
+
+    def test_threads(self):
+        for html_engine in HTML_ENGINES:
+            alone = self.convert_alone(html_engine)
+            converter = self.make_converter(html_engine)
+            archives = [None] * len(self.exports)
+            errors = []
+
+            def work(index):
+                try:
+                    archives[index] = self.convert(
+                        converter, self.exports[index]
+                    )
+                except Exception, e:
+                    errors.append(e)
+
+            threads = [
+                threading.Thread(target=work, args=(index, ))
+                for index in range(len(self.exports))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertSameArchives(archives, alone)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+from rcr_export_control.archiver import JATSArchiver
+from rcr_export_control.benchmark import make_export_xml
+from rcr_export_control.benchmark import make_stub_client
+from rcr_export_control.crosslinks import BibliographyResolver
+from rcr_export_control.crosslinks import CrosslinkEngine
+from rcr_export_control.crosslinks import FigureResolver
+from rcr_export_control.htmltree import HTML_ENGINES
+from rcr_export_control.log import get_logger
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.xml_tools import parse_export_xml
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+import shutil
+import tempfile
+import unittest
+
+
+# citations in the tails of inline elements, and the text they must keep
+TAIL_CITATIONS = [
+    (
+        '<p>Seen <em>in italic (2)</em> tail (3, 4) then (Fig. 2 and 3) '
+        'end [Fig. 1] done.</p>',
+        'Seen in italic (2) tail (3, 4) then (Fig. 2 and 3) end [Fig. 1] '
+        'done.',
+    ),
+    (
+        '<p>A <strong>bold</strong> (5) word.</p>',
+        'A bold (5) word.',
+    ),
+]
+
+
+class CitationTailTests(unittest.TestCase):
+    """citations in the tail of inline elements keep the text around them"""
+
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+        self.out_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.files_dir)
+        shutil.rmtree(self.out_path)
+
+    def convert(self, paragraph, html_engine):
+        """convert an article with paragraph at the top of its first section
+        """
+        heading = escape('<p class="subheading">Introduction</p>')
+        export = make_export_xml(self.files_dir, sections=1).replace(
+            heading, heading + escape(paragraph), 1
+        )
+        archiver = JATSArchiver(
+            parse_export_xml(StringIO(export)),
+            self.out_path,
+            pubmed_client=make_stub_client(),
+            html_engine=html_engine,
+        )
+        archiver.convert()
+        return archiver.parsed_xml.find('/body/sec/p')
+
+    def test_tail_text_is_kept(self):
+        for html_engine in HTML_ENGINES:
+            for paragraph, text in TAIL_CITATIONS:
+                converted = self.convert(paragraph, html_engine)
+                # the html engines differ in the whitespace they keep
+                found = ' '.join(''.join(converted.itertext()).split())
+                self.assertEqual(found, text)
+                self.assertTrue(converted.findall('xref'))
+
+
+class StubArchiver(object):
+    """the parts of an archiver used by the citation resolvers"""
+
+    def __init__(self, figures=3):
+        self.metrics = Metrics()
+        self.crosslink_log = get_logger('crosslinks')
+        self.figure_list = [
+            etree.Element('fig', id='fig-{0}'.format(number))
+            for number in range(1, figures + 1)
+        ]
+        self.diagnostics = []
+
+    def report(self, kind, **detail):
+        self.diagnostics.append(kind)
+
+
+class CrosslinkEngineTests(unittest.TestCase):
+
+    def resolve(self, markup):
+        paragraph = etree.XML(markup)
+        archiver = StubArchiver()
+        engine = CrosslinkEngine(
+            [FigureResolver(archiver), BibliographyResolver(archiver)]
+        )
+        engine.run(paragraph, [paragraph])
+        return paragraph
+
+    def xrefs(self, paragraph):
+        return [
+            (xref.get('ref-type'), xref.get('rid'), xref.text)
+            for xref in paragraph.iter('xref')
+        ]
+
+    def test_citations_in_text_and_tails(self):
+        paragraph = self.resolve(
+            '<p>Seen <italic>in italic (2)</italic> tail (3, 4) then '
+            '(Fig. 2 and 3) end [Fig. 1] done.</p>'
+        )
+        self.assertEqual(
+            ''.join(paragraph.itertext()),
+            'Seen in italic (2) tail (3, 4) then (Fig. 2 and 3) end '
+            '[Fig. 1] done.'
+        )
+        self.assertEqual(self.xrefs(paragraph), [
+            ('bibr', 'ref-2', '2'),
+            ('bibr', 'ref-3', '3'),
+            ('bibr', 'ref-4', '4'),
+            ('fig', 'fig-2', '2'),
+            ('fig', 'fig-3', '3'),
+            ('fig', 'fig-1', '1'),
+        ])
+        self.assertEqual(paragraph[0].tail, ' tail (')
+
+    def test_citation_first_in_tail(self):
+        paragraph = self.resolve('<p>A <bold>b</bold> (5) word.</p>')
+        self.assertEqual(''.join(paragraph.itertext()), 'A b (5) word.')
+        self.assertEqual(paragraph[0].tail, ' (')
+        self.assertEqual(paragraph[1].tail, ') word.')
+
+    def test_figure_suffix(self):
+        paragraph = self.resolve(
+            '<p>Masses <bold>x</bold> (Figs. 1A, C).</p>'
+        )
+        self.assertEqual(
+            ''.join(paragraph.itertext()), 'Masses x (Figs. 1A, C).'
+        )
+        self.assertEqual(self.xrefs(paragraph), [('fig', 'fig-1', '1A, C')])
+
+    def test_missing_figures(self):
+        archiver = StubArchiver(figures=2)
+        resolver = FigureResolver(archiver)
+        for ref in ('0', '3'):
+            xref = resolver.make_xref('fig', ref)
+            self.assertEqual(xref.get('rid'), 'placeholder')
+        self.assertEqual(archiver.diagnostics, ['missing-figure'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from rcr_export_control import manifest
+from rcr_export_control.manifest import CHANGED
+from rcr_export_control.manifest import ExportManifest
+from rcr_export_control.manifest import MANIFEST_SAVE_BATCH
+from rcr_export_control.manifest import UNCHANGED
+from rcr_export_control.manifest import check_article
+from rcr_export_control.manifest import hash_sources
+from rcr_export_control.manifest import make_entry
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class CheckArticleTests(unittest.TestCase):
+    """archives are only reused by the same code with the same settings"""
+
+    settings = {
+        'html_engine': 'soup',
+        'section_mapping': {'Teaching Point': 'conclusions'},
+        'schema_path': None,
+    }
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        archive_path = os.path.join(self.output_path, 'article.zip')
+        open(archive_path, 'wb').close()
+        self.entry = make_entry(
+            'export', archive_path, {}, None, self.settings
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+        manifest._tool_fingerprint = None
+
+    def check(self, settings):
+        return check_article(self.entry, 'export', self.output_path, settings)
+
+    def test_unchanged(self):
+        self.assertEqual(self.check(dict(self.settings)), UNCHANGED)
+
+    def test_settings_changed(self):
+        for key, value in [
+            ('html_engine', 'lxml'),
+            ('section_mapping', {'Teaching Point': None}),
+            ('schema_path', '/path/to/JATS-archivearticle1.dtd'),
+        ]:
+            settings = dict(self.settings)
+            settings[key] = value
+            self.assertEqual(self.check(settings), CHANGED)
+
+    def test_code_changed(self):
+        manifest._tool_fingerprint = 'another version of the code'
+        self.assertEqual(self.check(self.settings), CHANGED)
+
+    def test_hash_sources(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'module.py')
+            with open(path, 'w') as fh:
+                fh.write('VALUE = 1\n')
+            before = hash_sources(directory)
+            with open(os.path.join(directory, 'notes.txt'), 'w') as fh:
+                fh.write('not code\n')
+            self.assertEqual(hash_sources(directory), before)
+            with open(path, 'w') as fh:
+                fh.write('VALUE = 2\n')
+            self.assertNotEqual(hash_sources(directory), before)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ExportManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def test_saved_in_batches(self):
+        manifest = ExportManifest(self.output_path)
+        for articleid in range(1, MANIFEST_SAVE_BATCH):
+            manifest.update(articleid, {'archive': 'a.zip'})
+            manifest.save_if_due()
+        self.assertFalse(os.path.exists(manifest.path))
+        manifest.update(MANIFEST_SAVE_BATCH, {'archive': 'a.zip'})
+        manifest.save_if_due()
+        self.assertEqual(
+            len(ExportManifest(self.output_path).articles),
+            MANIFEST_SAVE_BATCH
+        )
+        manifest.update('extra', {'archive': 'a.zip'})
+        manifest.save()
+        self.assertEqual(
+            ExportManifest(self.output_path).get('extra'),
+            {'archive': 'a.zip'}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from rcr_export_control.mediastore import MediaStore
+from rcr_export_control.zipwriter import ArchiveWriter
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+
+class MediaStoreTests(unittest.TestCase):
+    """files are taken from the store whether deflated or stored"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MediaStore(os.path.join(self.directory, 'store'))
+        size = self.store.min_size * 2
+        # an image is stored uncompressed, text is deflated
+        self.files = {
+            'figure.jpg': os.urandom(size),
+            'data.txt': 'figure data\n' * (size // 12),
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.directory, name), 'wb') as fh:
+                fh.write(data)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def archive(self, name):
+        path = os.path.join(self.directory, name)
+        with ArchiveWriter(path, store=self.store) as archive:
+            for filename in sorted(self.files):
+                archive.write(
+                    os.path.join(self.directory, filename), filename
+                )
+        with zipfile.ZipFile(path) as written:
+            self.assertIsNone(written.testzip())
+            content = dict(
+                (filename, written.read(filename))
+                for filename in written.namelist()
+            )
+            types = dict(
+                (info.filename, info.compress_type)
+                for info in written.infolist()
+            )
+        self.assertEqual(content, self.files)
+        return archive, types
+
+    def test_reuse(self):
+        first, types = self.archive('first.zip')
+        self.assertEqual(first.spliced, 0)
+        self.assertEqual(types, {
+            'figure.jpg': zipfile.ZIP_STORED,
+            'data.txt': zipfile.ZIP_DEFLATED,
+        })
+        second, types = self.archive('second.zip')
+        self.assertEqual(second.spliced, 2)
+
+    def test_changed_file(self):
+        self.archive('first.zip')
+        path = os.path.join(self.directory, 'figure.jpg')
+        self.files['figure.jpg'] = os.urandom(len(self.files['figure.jpg']))
+        with open(path, 'wb') as fh:
+            fh.write(self.files['figure.jpg'])
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        second, types = self.archive('second.zip')
+        self.assertEqual(second.spliced, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from rcr_export_control.xml_tools import FileIndex
+
+import unittest
+
+
+class FileIndexTests(unittest.TestCase):
+    """files are found by trailing parts of their path, as links name them"""
+
+    def setUp(self):
+        self.figure = {'filename': 'fig1.jpg', 'path': 'files/a/12-fig1.jpg'}
+        self.table = {'filename': 'table.pdf', 'path': 'files/b/13-table.pdf'}
+        self.index = FileIndex(
+            {'fig1.jpg': [self.figure]}, {'table.pdf': [self.table]}
+        )
+
+    def test_find(self):
+        self.assertEqual(self.index.find('fig1.jpg'), [self.figure])
+        self.assertEqual(self.index.find('12-fig1.jpg'), [])
+
+    def test_find_by_path(self):
+        for path in ['fig1.jpg', '12-fig1.jpg', 'a/12-fig1.jpg',
+                     './files/a/12-fig1.jpg']:
+            self.assertEqual(self.index.find_by_path(path), [self.figure])
+        self.assertEqual(self.index.find_by_path('b/12-fig1.jpg'), [])
+
+    def test_find_by_path_without_extension(self):
+        for path in ['fig1', '12-fig1', 'a/12-fig1']:
+            self.assertEqual(self.index.find_by_path(path), [self.figure])
+        self.assertEqual(self.index.find_by_path('table'), [self.table])
+
+    def test_leading_parts_and_ambiguity(self):
+        self.assertEqual(self.index.find_by_path('files'), [])
+        self.assertEqual(self.index.find_by_path('.jpg'), [self.figure])
+        self.index.add({'filename': 'x.jpg', 'path': 'files/b/x.jpg'})
+        self.assertEqual(len(self.index.find_by_path('.jpg')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,26 @@
 # -*- coding: utf-8 -*-
 from rcr_export_control import constants
 from rcr_export_control.archiver import JATSArchiver
+from rcr_export_control.log import get_logger
+from rcr_export_control.log import NOTICE
+from rcr_export_control.metrics import Metrics
+from rcr_export_control.pubmed import PubMedClient
+from rcr_export_control.validation import get_schema
 from rcr_export_control.xml_tools import parse_export_xml
+from StringIO import StringIO
+from contextlib import closing
+from contextlib import contextmanager
 from subprocess import Popen
 from subprocess import PIPE
 from subprocess import CalledProcessError
 
+import fcntl
 import mimetypes
 import os
+import shutil
 import sys
+import tempfile
+import threading
 
 
 class MissingBinary(Exception): 
@@ -85,30 +97,253 @@ def bin_search(binary, default=_marker):
 
 
 def execute_php_export(command, articleid):
-    print "PHP Exporting article {0}:\n\t`$ {1}\n`".format(articleid, command)
+    log = get_logger('export', article=articleid)
+    log.log(NOTICE, "PHP Exporting article %s:\n`$ %s`", articleid, command)
     args = command.split()
     process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
     pout, perr = process.communicate()
     code = process.poll()
     if code or pout or perr:
-        output = pout + perr
-        try:
-            raise CalledProcessError(
-                code, command, output=output
-            )
-        except Exception:
-            error = CalledProcessError(code, command)
-            error.output = output
-            raise error
-    print "PHP export of article {0} complete\n".format(articleid)
+        _raise_export_error(code, command, pout + perr)
+    log.log(NOTICE, "PHP export of article %s complete", articleid)
     return code
 
 
-def create_article_archive(out_path, exported, log_level=0):
-    parsed = parse_export_xml(exported)
-    archiver = JATSArchiver(parsed, out_path, log_level)
-    archiver.convert()
-    archiver.archive()
-    
-    # clean up memory space:
-    del archiver
+def list_published_articles(command):
+    """yield the ids of published articles listed by a PHP command
+
+    ids are yielded as PHP prints them, one per line, so that articles may
+    be exported before the listing is complete.  CalledProcessError is
+    raised once the listing ends if PHP failed or printed anything else.
+    """
+    get_logger('export').log(NOTICE, "Listing articles:\n`$ %s`", command)
+    process = Popen(
+        command.split(), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+        close_fds=True,
+    )
+    process.stdin.close()
+    errors = []
+    collector = threading.Thread(
+        target=lambda: errors.append(process.stderr.read())
+    )
+    collector.daemon = True
+    collector.start()
+    try:
+        for line in iter(process.stdout.readline, ''):
+            line = line.strip()
+            if line.isdigit():
+                yield int(line)
+            elif line:
+                errors.append(line + '\n')
+    finally:
+        process.stdout.close()
+        collector.join()
+        process.wait()
+    if process.returncode or ''.join(errors):
+        _raise_export_error(process.returncode, command, ''.join(errors))
+
+
+def _raise_export_error(code, command, output):
+    try:
+        raise CalledProcessError(
+            code, command, output=output
+        )
+    except Exception:
+        error = CalledProcessError(code, command)
+        error.output = output
+        raise error
+
+
+@contextmanager
+def stream_php_export(make_command, articleid):
+    """run a PHP export through a fifo, yielding a file to read it from
+
+    `make_command` is called with the path of the fifo and returns the
+    command line exporting the article to it.  The export may be read while
+    PHP is still writing it, and is never stored on disk.  PHP stdout and
+    stderr are collected by threads, so a chatty exporter cannot block on
+    them.  On leaving the context, CalledProcessError is raised if the
+    export failed, in preference to any error raised while reading it.
+    """
+    directory = tempfile.mkdtemp()
+    fifo_path = os.path.join(directory, 'export.xml')
+    os.mkfifo(fifo_path, 0o600)
+    # open the read end without waiting for a writer, then hold a write end
+    # open until PHP exits, so reads wait for PHP rather than end early
+    read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    hold_fd = os.open(fifo_path, os.O_WRONLY)
+    flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+    fcntl.fcntl(read_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    exported = os.fdopen(read_fd, 'rb')
+
+    command = make_command(fifo_path)
+    log = get_logger('export', article=articleid)
+    log.log(NOTICE, "PHP Exporting article %s:\n`$ %s`", articleid, command)
+    try:
+        # PHP must not hold the read end of the fifo open itself
+        process = Popen(
+            command.split(), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+            close_fds=True,
+        )
+    except Exception:
+        exported.close()
+        os.close(hold_fd)
+        shutil.rmtree(directory)
+        raise
+    process.stdin.close()
+    output = {}
+
+    def collect(name, pipe):
+        output[name] = pipe.read()
+
+    def wait():
+        readers = [
+            threading.Thread(target=collect, args=(name, pipe))
+            for name, pipe in [('out', process.stdout), ('err', process.stderr)]
+        ]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        process.wait()
+        os.close(hold_fd)
+
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+    try:
+        try:
+            yield exported
+        finally:
+            # a reader giving up early must not leave PHP blocked on a full
+            # fifo
+            exported.close()
+            waiter.join()
+            shutil.rmtree(directory)
+    except Exception:
+        if not (process.returncode or output['out'] or output['err']):
+            raise
+    code = process.returncode
+    if code or output['out'] or output['err']:
+        _raise_export_error(code, command, output['out'] + output['err'])
+    log.log(NOTICE, "PHP export of article %s complete", articleid)
+
+
+class ExportSource(object):
+    """the xml exported for an article
+
+    held in a file at `path`, in memory as `data` or, while PHP is still
+    writing it, read from `stream`.  A stream can only be read once, unless
+    it is first spooled into memory.
+    """
+
+    def __init__(self, path=None, data=None, stream=None):
+        self.path = path
+        self.data = data
+        self.stream = stream
+
+    def open(self):
+        """return a file to read the export from"""
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            return stream
+        if self.data is not None:
+            return closing(StringIO(self.data))
+        return open(self.path, 'rb')
+
+    def spool(self):
+        """read a stream into memory, so the export may be read again"""
+        if self.stream is not None:
+            with self.open() as fh:
+                self.data = fh.read()
+
+    def discard(self):
+        """remove the file holding the export, if any"""
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ArticleConverter(object):
+    """converts exported articles and writes their archives to out_path
+
+    a converter holds only what is shared by every article, each article is
+    converted by a `JATSArchiver` of its own.  So one converter may be
+    reused for any number of articles, and by several threads at once.
+    `html_engine` names the engine parsing the html markup of articles, see
+    `htmltree`.  Given a `mediastore.MediaStore`, files deflated into one
+    archive are reused by the next.  `section_types` is the
+    `sections.SectionTypes` giving the section type of each heading.  If
+    `schema_path` is given, each article is validated against the schema
+    there once converted, see `validation`.
+    """
+
+    archiver_class = JATSArchiver
+
+    def __init__(
+        self, out_path, pubmed_client=None, html_engine=None, media_store=None,
+        section_types=None, schema_path=None,
+    ):
+        self.out_path = out_path
+        if pubmed_client is None:
+            pubmed_client = PubMedClient()
+        self.pubmed_client = pubmed_client
+        self.html_engine = html_engine
+        self.media_store = media_store
+        self.section_types = section_types
+        self.schema_path = schema_path
+
+    def convert(self, exported, metrics=None, sources=None):
+        """convert exported xml, read from a file, and write its archive
+
+        returns the path to the archive.  If `sources` is given, it is
+        updated with the filesystem path of each file copied into the
+        archive, keyed by its name in the archive.
+        """
+        archiver = self._convert(exported, metrics)
+        archive_path = archiver.archive()
+        if sources is not None:
+            sources.update(archiver.files_to_archive)
+            sources.update(archiver.media_files_to_archive)
+        return archive_path
+
+    def check(self, exported, metrics=None):
+        """convert exported xml, read from a file, without archiving it
+
+        returns the problems found in the article, see
+        `JATSArchiver.report`.
+        """
+        return self._convert(exported, metrics).diagnostics
+
+    def _convert(self, exported, metrics):
+        if metrics is None:
+            metrics = Metrics()
+        with metrics.timer('parse_export'):
+            parsed = parse_export_xml(exported)
+        archiver = self.archiver_class(
+            parsed,
+            self.out_path,
+            pubmed_client=self.pubmed_client,
+            metrics=metrics,
+            html_engine=self.html_engine,
+            media_store=self.media_store,
+            section_types=self.section_types,
+        )
+        archiver.convert()
+        if self.schema_path is not None:
+            archiver.validate(get_schema(self.schema_path))
+        return archiver
+
+
+def create_article_archive(
+    out_path, exported, pubmed_client=None, metrics=None, sources=None,
+    html_engine=None, media_store=None, section_types=None, schema_path=None,
+):
+    """convert exported xml and write its archive to out_path
+
+    returns the path to the archive, see `ArticleConverter.convert`.
+    """
+    converter = ArticleConverter(
+        out_path, pubmed_client, html_engine, media_store, section_types,
+        schema_path,
+    )
+    return converter.convert(exported, metrics, sources)
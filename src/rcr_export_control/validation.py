@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""validation of article xml against a local JATS schema
+
+the schema may be a DTD, like the JATS archiving DTD with its modules, a
+W3C XML schema or a RELAX NG schema, told apart by the extension of its
+file.  Schemas are only ever read from local files, never the network.
+"""
+from argparse import ArgumentTypeError
+from lxml import etree
+
+import os
+import threading
+
+
+SCHEMA_EXTENSIONS = ('.dtd', '.xsd', '.rng')
+# validation errors reported for an article, the rest are only counted
+MAX_ERRORS = 50
+
+# schemas are parsed once by each thread validating against them.  A
+# validator keeps the errors of its last validation, so it cannot be shared
+# by threads.
+_schemas = threading.local()
+
+
+def parse_schema(path):
+    """parse the schema in the file at path into a validator"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.dtd':
+        return etree.DTD(path)
+    parser = etree.XMLParser(no_network=True)
+    document = etree.parse(path, parser)
+    if extension == '.xsd':
+        return etree.XMLSchema(document)
+    if extension == '.rng':
+        return etree.RelaxNG(document)
+    raise ValueError("unknown type of schema {0!r}".format(path))
+
+
+def get_schema(path):
+    """return the validator of the schema at path, parsed once per thread
+
+    pool processes call this as they start, so that no article waits for
+    the schema to be parsed.
+    """
+    schemas = getattr(_schemas, 'by_path', None)
+    if schemas is None:
+        schemas = _schemas.by_path = {}
+    schema = schemas.get(path)
+    if schema is None:
+        schema = schemas[path] = parse_schema(path)
+    return schema
+
+
+def validate(tree, schema):
+    """validate an element tree, returning the errors found
+
+    errors are a list of (path, message) tuples, where path is the xpath
+    of the element in error, like '/article/body/sec[2]'.
+    """
+    if schema.validate(tree):
+        return []
+    return [(entry.path, entry.message) for entry in schema.error_log]
+
+
+def parse_schema_path(value):
+    """check a schema given on the command line, returning its full path"""
+    if os.path.splitext(value)[1].lower() not in SCHEMA_EXTENSIONS:
+        raise ArgumentTypeError(
+            "unknown type of schema {0!r}, expected a file ending in "
+            "{1}".format(value, ', '.join(SCHEMA_EXTENSIONS))
+        )
+    if not os.path.isfile(value):
+        raise ArgumentTypeError("no schema found at {0!r}".format(value))
+    return os.path.abspath(value)
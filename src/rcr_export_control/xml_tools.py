@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
-from bs4 import BeautifulSoup
-from bs4 import element
-from cStringIO import StringIO
 from lxml import etree
 from rcr_export_control import constants
-from urlparse import urlparse
-from urlparse import parse_qs
-
+from rcr_export_control.htmltree import is_tag
+from rcr_export_control.htmltree import is_text
+from rcr_export_control.htmltree import parse_html
+from rcr_export_control.htmltree import DEFAULT_HTML_ENGINE
+from rcr_export_control.sections import SectionTypes
+from urllib import unquote
+
+import codecs
 import mimetypes
 import os
 import re
@@ -23,33 +25,133 @@ XML_ILLEGALS = u'|'.join(u'[%s-%s]' % (s, e) for s, e in [
     ])
 RE_SANITIZE_XML = re.compile(XML_ILLEGALS, re.M | re.U)
 REF_PAT = re.compile('(\d{1,3})\.')
+SANITIZE_CHUNK_SIZE = 64 * 1024
+# inline citations of figures, like '(Figs. 1, 2A)', or of the bibliography,
+# like '(1, 2)'.  Figure citations run to a closing bracket or the end of the
+# text in which they are found.
+CITATION_PAT = re.compile(
+    r'(?P<fig>[\(\[]figs?\.)(?P<fig_ids>[^\)\]]*)|\((?P<bibr_ids>[\d,\s]+)\)',
+    re.I
+)
+FIGURE_ID_PAT = re.compile(r'[\da-zA-Z-]{1,5}')
+BIBR_ID_PAT = re.compile(r'\d+')
+DIGIT_PAT = re.compile(r'\d{1,3}')
+MEDIA_URL_CACHE_SIZE = 4096
+# the section types of headings, when no mapping file is given
+DEFAULT_SECTION_TYPES = SectionTypes()
+# links to a reference in PubMed, in PubMed Central or by DOI, whether
+# escaped or not.  The name of the group matched tells the kind of id.
+REFERENCE_LINK_PAT = re.compile(
+    r'list_uids=(?P<uids>\d+)'
+    r'|(?:pubmed\.ncbi\.nlm\.nih\.gov|ncbi\.nlm\.nih\.gov/pubmed)/'
+    r'(?P<pubmed>\d+)'
+    r'|(?:ncbi\.nlm\.nih\.gov/pmc|pmc\.ncbi\.nlm\.nih\.gov)/articles/'
+    r'(?P<pmcid>pmc\d+)'
+    r'|doi\.org/(?P<doi>10\.\d{4,9}(?:/|%2f)[^\s?#"\'<>]+)',
+    re.I
+)
+REFERENCE_LINK_KINDS = {
+    'uids': 'pmid',
+    'pubmed': 'pmid',
+    'pmcid': 'pmcid',
+    'doi': 'doi',
+}
+# of the links in a reference, the kind of id preferred
+REFERENCE_ID_RANKS = {'pmid': 0, 'pmcid': 1, 'doi': 2}
+REFERENCE_LINK_CACHE_SIZE = 4096
+# overlap kept between chunks so ids split across two chunks are found
+PUBMED_LINK_OVERLAP = 64
+
+# filename -> whether it names a media file, see is_media_url
+_media_urls = {}
+# href -> the id of the reference it links to, see parse_reference_link
+_reference_links = {}
 
 
 def parse_export_xml(exported):
-    """parse the xml exported by the PHP JATS exporter plugin"""
+    """parse the xml exported by the PHP JATS exporter plugin
+
+    the export is sanitized and fed to the parser one chunk at a time, so the
+    whole document is never held in memory as a string.
+    """
     parser = etree.XMLParser(encoding='utf-8')
-    fixed = StringIO(remove_illegal_chars(exported))
-    parsed = etree.parse(fixed, parser)
-    return parsed
+    for chunk in iter_sanitized_chunks(exported):
+        parser.feed(chunk)
+    return parser.close().getroottree()
+
+
+def iter_sanitized_chunks(exported, chunk_size=SANITIZE_CHUNK_SIZE):
+    """yield utf-8 chunks of `exported` with illegal XML characters removed
+
+    `exported` is read and decoded incrementally, so multibyte characters
+    split across the boundary of two chunks are handled correctly.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = exported.read(chunk_size)
+        final = not data
+        decoded = decoder.decode(data, final)
+        if decoded:
+            yield RE_SANITIZE_XML.sub(u'', decoded).encode('utf-8')
+        if final:
+            break
 
 
 def remove_illegal_chars(exported):
     """remove illegal characters for XML from the source exported from PHP"""
-    decoded_source = exported.read().decode('utf-8')
-    sanitized = RE_SANITIZE_XML.sub('', decoded_source)
-    return sanitized.encode('utf-8')
+    return ''.join(iter_sanitized_chunks(exported))
+
 
+def scan_pubmed_ids(exported):
+    """return the distinct PubMed ids linked anywhere in an export, in order
 
-def parse_article_html(html_node):
+    the export is scanned as text, without parsing it, so that references
+    can be looked up before the article is converted.
+
+    >>> from StringIO import StringIO
+    >>> scan_pubmed_ids(StringIO(
+    ...     '<a href="query.fcgi?db=pubmed&amp;list_uids=20271775">'
+    ...     '<a href="query.fcgi?list_uids=19145081&amp;query_hl=9">'
+    ...     '<a href="https://doi.org/10.1148/radiol.2501080542">'
+    ...     '<a href="https://pubmed.ncbi.nlm.nih.gov/20271775/">'
+    ...     '<a href="https://pubmed.ncbi.nlm.nih.gov/18812345/">'
+    ... ))
+    ['20271775', '19145081', '18812345']
+    """
+    found = []
+    seen = set()
+
+    def scan(text, limit):
+        for match in REFERENCE_LINK_PAT.finditer(text):
+            if match.start() >= limit:
+                break
+            pmid = match.group('uids') or match.group('pubmed')
+            if pmid is not None and pmid not in seen:
+                seen.add(pmid)
+                found.append(pmid)
+
+    tail = ''
+    for chunk in iter_sanitized_chunks(exported):
+        text = tail + chunk
+        # a link near the end of the chunk may continue in the next one, so
+        # it is left to be scanned along with that
+        limit = max(0, len(text) - PUBMED_LINK_OVERLAP)
+        scan(text, limit)
+        tail = text[limit:]
+    scan(tail, len(tail))
+    return found
+
+
+def parse_article_html(html_node, engine=DEFAULT_HTML_ENGINE):
     """parse the html contained in an article node
 
-    use beautiful soup because it will try to normalize the messy html we
-    are likely to see.
+    both engines will try to normalize the messy html we are likely to see,
+    see `htmltree` for how they differ.
     """
     if html_node is None:
         return
 
-    parsed = BeautifulSoup(html_node.text)
+    parsed = parse_html(html_node.text, engine)
     return parsed
 
 
@@ -131,32 +233,148 @@ def convert_supplemental_files(supp_node):
     return files
 
 
-def set_sec_type(sec, heading):
-    """set the 'sec_type' attribute of 'sec', if applicable"""
-    comp = heading.lower()
-    sec_type = None
-    if comp in constants.JATS_SEC_TYPES:
-        sec_type = comp
-    if comp in constants.RCR_TO_JATS_SEC_MAPPING:
-        sec_type = constants.RCR_TO_JATS_SEC_MAPPING[comp]
+def normalize_path(path):
+    """return a path, or the path part of a link, in a comparable form
+
+    >>> normalize_path('./files//journals/1/a.jpg')
+    'files/journals/1/a.jpg'
+    >>> normalize_path('/files/../a.jpg')
+    'a.jpg'
+    """
+    parts = []
+    for part in path.split('/'):
+        if part == '..':
+            if parts:
+                parts.pop()
+        elif part and part != '.':
+            parts.append(part)
+    return '/'.join(parts)
+
 
+def iter_path_suffixes(path):
+    """yield each trailing part of a normalized path, shortest first
+
+    trailing parts of the file name are included, since stored files are
+    often named for the original with a prefix, like '12-fig1.jpg'.
+
+    >>> list(iter_path_suffixes('a/b/c.jpg'))
+    ['g', 'pg', 'jpg', '.jpg', 'c.jpg', 'b/c.jpg', 'a/b/c.jpg']
+    """
+    position = path.rfind('/')
+    for start in range(len(path) - 1, position, -1):
+        yield path[start:]
+    while position >= 0:
+        position = path.rfind('/', 0, position)
+        yield path[position + 1:]
+
+
+class FileIndex(object):
+    """index of converted file infos for constant time lookups
+
+    infos are found by the filename stored by the exporter, or by any
+    trailing part of their normalized path, with or without its extension,
+    like 'b/12-c.jpg', 'c.jpg' or 'c' for 'a/b/12-c.jpg'.
+    Lookups return lists of infos in the order the storages were given, so
+    the first candidate is the same one a search of the storages in turn
+    would find, and more than one candidate means the lookup is ambiguous.
+    """
+
+    def __init__(self, *storages):
+        self.by_filename = {}
+        self.by_path = {}
+        for storage in storages:
+            self.update(storage)
+
+    def update(self, storage):
+        """index the infos in a storage made by `convert_galley` et al."""
+        for infos in storage.values():
+            for info in infos:
+                self.add(info)
+
+    def add(self, info):
+        store_item_by_key(self.by_filename, info, 'filename')
+        if info.get('path'):
+            path = normalize_path(info['path'])
+            # links often leave out the extension of the file
+            suffixes = set(iter_path_suffixes(path))
+            suffixes.update(iter_path_suffixes(os.path.splitext(path)[0]))
+            for suffix in suffixes:
+                self.by_path.setdefault(suffix, []).append(info)
+
+    def find(self, filename):
+        return list(self.by_filename.get(filename, ()))
+
+    def find_by_path(self, path):
+        return list(self.by_path.get(normalize_path(path), ()))
+
+
+def set_sec_type(sec, heading, section_types=None):
+    """set the 'sec_type' attribute of 'sec', if applicable
+
+    `section_types` is the `sections.SectionTypes` to look the heading up in,
+    by default those known to `constants`.
+    """
+    if section_types is None:
+        section_types = DEFAULT_SECTION_TYPES
+    sec_type = section_types.lookup(heading)
     if sec_type:
         sec.set('sec-type', sec_type)
 
 
 def convert_tag_type(tag):
     """convert html tag types to JATS xml compliant tag types"""
-    if tag.name in constants.HTML_TO_JATS_MAPPING:
-        return constants.HTML_TO_JATS_MAPPING[tag.name]
-    else:
-        return tag.name
+    name = tag.name
+    return constants.HTML_TO_JATS_MAPPING.get(name, name)
 
 
-def extract_reference_pmids(html):
-    """given a reference header, find the reference paragraph and get pmids
+def parse_reference_link(href):
+    """return the (kind, id) of the reference an href links to, or None
+
+    kinds are 'pmid', 'pmcid' and 'doi'.  Results are memoized by href, as
+    the same references are cited by many articles.
+
+    >>> parse_reference_link('https://pubmed.ncbi.nlm.nih.gov/20271775/')
+    ('pmid', '20271775')
+    >>> parse_reference_link('http://dx.doi.org/10.1148%2FRadiol.250%2F1')
+    ('doi', '10.1148/radiol.250/1')
+    >>> parse_reference_link('http://radiology.casereports.net/index.php')
+    """
+    try:
+        return _reference_links[href]
+    except KeyError:
+        pass
+
+    link = None
+    match = REFERENCE_LINK_PAT.search(href)
+    if match is not None:
+        kind = REFERENCE_LINK_KINDS[match.lastgroup]
+        value = match.group(match.lastgroup)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if kind == 'pmcid':
+            value = value.upper()
+        elif kind == 'doi':
+            # DOIs are case insensitive
+            value = unquote(value).lower()
+        link = (kind, value)
+
+    if len(_reference_links) >= REFERENCE_LINK_CACHE_SIZE:
+        _reference_links.clear()
+    _reference_links[href] = link
+    return link
+
+
+def extract_reference_ids(html):
+    """find the id of each reference in the reference paragraphs
     
+    returns a (kind, id) tuple for each reference, see
+    `parse_reference_link`, or None for a reference without a link to its
+    id.  Of several links in a reference, a PubMed link is preferred, then
+    one to PubMed Central, then a DOI.  The paragraphs are walked once,
+    each reference starting with a number like '1.'.
+
     HTML input should look something like this:
-    <p class="subheading">References</p> <-- this is the incoming tag
+    <p class="subheading">References</p>
     <p class="references">
     1. Barrett NR. Report of a case of spontaneous perforation of the oesophagus successfully treated by operation.
     <em>
@@ -181,40 +399,50 @@ def extract_reference_pmids(html):
     <br/>
     <br/>
     """
-    pmids = []
-    pmid_candidate = [None]
-    seeking_pmid = False
+    ids = []
+    candidate = None
+    seeking = False
     ref_graphs = html.find_all('p', class_='references')
     # iterate over each reference paragraph:
     for ref_graph in ref_graphs:
         # iterate over immediate child nodes in the paragraph
         for node in ref_graph.children:
             # look for navigable strings (these might be our references)
-            if isinstance(node, element.NavigableString):
+            if is_text(node):
                 # check to see if the current navigable string starts with
                 # an integer (this is definitely a reference)
-                match = REF_PAT.match(node.strip())
-                if match is not None:
-                    # new_pmid_count = int(match.groups()[0])
-                    # # have we reached a new reference?
-                    # if new_pmid_count > current_pmid_count:
-                    if seeking_pmid:
-                        pmids.extend(pmid_candidate)
-                        pmid_candidate = [None]
+                if REF_PAT.match(node.strip()) is not None:
+                    if seeking:
+                        ids.append(candidate)
+                        candidate = None
                     else:
-                        seeking_pmid = True
-                    # current_pmid_count = new_pmid_count
-            elif isinstance(node, element.Tag) and node.name == ('a'):
+                        seeking = True
+            elif is_tag(node) and node.name == 'a':
                 url = node.get('href')
-                if url is not None:
-                    query = urlparse(url).query
-                    if query:
-                        qdict = parse_qs(query)
-                        if 'list_uids' in qdict:
-                            pmid_candidate = qdict['list_uids']
-    # at the end of it all, we append whatever pmid_candidate we have
-    pmids.extend(pmid_candidate)
-    return pmids
+                if url is None:
+                    continue
+                link = parse_reference_link(url)
+                if link is not None and (
+                    candidate is None or
+                    REFERENCE_ID_RANKS[link[0]] <=
+                    REFERENCE_ID_RANKS[candidate[0]]
+                ):
+                    candidate = link
+    # at the end of it all, we append whatever candidate we have
+    ids.append(candidate)
+    return ids
+
+
+def extract_reference_pmids(html):
+    """return the PubMed id of each reference, or None if it has no link
+
+    see `extract_reference_ids`, references linked by other ids than their
+    PubMed ids are given None.
+    """
+    return [
+        link[1] if link is not None and link[0] == 'pmid' else None
+        for link in extract_reference_ids(html)
+    ]
 
 
 def set_namespaced_attribute(node, a_name, a_value, prefix=None):
@@ -251,17 +479,29 @@ def is_internal(href):
 
 
 def is_media_url(href):
-    mime = mimetypes.guess_type(os.path.basename(href))
-    if mime[0] is None:
-        # in rcr, this is urls like 
-        # http://radiology.casereports.net/index.php/rcr/article/view/433/1117
-        return False
-
-    prefix = mime[0].split('/')[0]
-    if prefix in constants.MEDIA_MIME_TYPE_PREFIXES:
-        return True
+    """determine if an href links to a media file, judging by its name
 
-    return False
+    results are memoized by filename, as the same few file types are linked
+    over and over in a batch of articles.
+    """
+    filename = os.path.basename(href)
+    try:
+        return _media_urls[filename]
+    except KeyError:
+        pass
+
+    is_media = False
+    mime = mimetypes.guess_type(filename)
+    # a mime type of None is urls like
+    # http://radiology.casereports.net/index.php/rcr/article/view/433/1117
+    if mime[0] is not None:
+        prefix = mime[0].split('/')[0]
+        is_media = prefix in constants.MEDIA_MIME_TYPE_PREFIXES
+
+    if len(_media_urls) >= MEDIA_URL_CACHE_SIZE:
+        _media_urls.clear()
+    _media_urls[filename] = is_media
+    return is_media
 
 
 def get_index_from_figure_ref(ref):
@@ -272,12 +512,58 @@ def get_index_from_figure_ref(ref):
     >>> get_index_from_figure_ref('2a')
     1
     """
-    dig_pat = re.compile('[\d]{1,3}')
-    match = dig_pat.search(ref)
+    match = DIGIT_PAT.search(ref)
     if match is None:
         return None
 
-    return int(ref[match.start():match.end()]) - 1
+    return int(match.group()) - 1
+
+
+def iter_citation_tokens(text):
+    """split text into plain text and inline citations in a single pass
+
+    yields (kind, value) tuples, where kind is one of:
+
+    'text': plain text to be kept as it is
+    'fig': the id of a cited figure, like '1' or '2A-C'
+    'fig-suffix': text continuing the previous 'fig' id, as in '(Figs 1A, C)'
+    'bibr': the number of a cited reference
+
+    >>> list(iter_citation_tokens('see (Figs. 1A and 2) and (3, 4).'))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('text', 'see (Figs. '), ('fig', '1A'), ('text', ' and '), ('fig', '2'),
+     ('text', ') and ('), ('bibr', '3'), ('text', ', '), ('bibr', '4'),
+     ('text', ').')]
+    >>> list(iter_citation_tokens('(Figs. 1A, C)'))
+    [('text', '(Figs. '), ('fig', '1A'), ('fig-suffix', ', C'), ('text', ')')]
+    """
+    position = 0
+    for match in CITATION_PAT.finditer(text):
+        if match.group('fig') is not None:
+            group, kind, id_pat = 'fig_ids', 'fig', FIGURE_ID_PAT
+        else:
+            group, kind, id_pat = 'bibr_ids', 'bibr', BIBR_ID_PAT
+        offset = match.start(group)
+        previous = None
+        for id_match in id_pat.finditer(match.group(group)):
+            token = id_match.group()
+            start = offset + id_match.start()
+            end = offset + id_match.end()
+            if kind == 'bibr' or DIGIT_PAT.search(token) is not None:
+                token_kind = kind
+            elif previous in ('fig', 'fig-suffix') and token.lower() != 'and':
+                # a bare letter continues the previous figure id
+                token_kind = 'fig-suffix'
+                start = position
+            else:
+                continue
+            if start > position:
+                yield 'text', text[position:start]
+            yield token_kind, text[start:end]
+            position = end
+            previous = token_kind
+    if position < len(text):
+        yield 'text', text[position:]
 
 
 class DateParserXSLTExtension(etree.XSLTExtension):
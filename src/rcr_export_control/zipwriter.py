@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+
+import os
+import tempfile
+import time
+import zipfile
+import zlib
+
+
+COPY_CHUNK_SIZE = 64 * 1024
+# files of these types are compressed already, deflating them again costs
+# cpu time and saves next to nothing
+COMPRESSED_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff',
+    '.mp4', '.m4v', '.mov', '.avi', '.wmv', '.flv', '.mpg', '.mpeg',
+    '.mp3', '.m4a', '.ogg', '.wav',
+    '.pdf', '.zip', '.gz', '.bz2', '.docx', '.pptx', '.xlsx',
+])
+# other files are deflated unless a sample from their start deflates to
+# more than STORE_RATIO of its size
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+STORE_RATIO = 0.9
+# files deflated at least this large are compressed in worker threads
+PARALLEL_THRESHOLD = 1024 * 1024
+DEFAULT_THREADS = 4
+
+# temporary archives are created private, the finished archive gets the
+# permissions a newly created file would have
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def choose_compress_type(path):
+    """return the zipfile compression type that pays for the file at path"""
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+
+    with open(path, 'rb') as fh:
+        sample = fh.read(ENTROPY_SAMPLE_SIZE)
+    if sample and len(zlib.compress(sample, 1)) > len(sample) * STORE_RATIO:
+        return zipfile.ZIP_STORED
+
+    return zipfile.ZIP_DEFLATED
+
+
+def deflate_file(path):
+    """return the crc, size and raw deflated data of the file at path
+
+    zlib releases the GIL while compressing, so several files may be
+    deflated at once in threads.
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+    )
+    crc = 0
+    size = 0
+    chunks = []
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            crc = zlib.crc32(data, crc)
+            chunks.append(compressor.compress(data))
+    chunks.append(compressor.flush())
+    return crc & 0xffffffff, size, ''.join(chunks)
+
+
+class ZipEntry(object):
+    """file-like object writing into a single entry of a zip archive
+
+    data is compressed as it is written, the local header is rewritten with
+    the final crc and sizes when the entry is closed.
+    """
+
+    def __init__(self, archive, zinfo):
+        self.archive = archive
+        self.zinfo = zinfo
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+            )
+        else:
+            self.compressor = None
+        # the crc and sizes are written again once they are known
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+        zinfo.flag_bits = 0
+        zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(zinfo)
+        archive._didModify = True
+        archive.fp.write(zinfo.FileHeader(False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self.file_size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data):
+        self.compress_size += len(data)
+        self.archive.fp.write(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+        self._finish(self.crc, self.file_size, self.compress_size)
+
+    def _finish(self, crc, file_size, compress_size):
+        zinfo = self.zinfo
+        if file_size > zipfile.ZIP64_LIMIT or \
+                compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Zip entry {0} is too large'.format(
+                zinfo.filename
+            ))
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        # seek back and write the header again, now with the correct crc and
+        # sizes
+        fp = self.archive.fp
+        position = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader(False))
+        fp.seek(position)
+        self.archive.filelist.append(zinfo)
+        self.archive.NameToInfo[zinfo.filename] = zinfo
+
+
+class ArchiveWriter(object):
+    """write a zip archive atomically, deflating large files in parallel
+
+    entries go to a temporary file next to `path`, which replaces `path`
+    only once the archive is complete, so a partially written archive never
+    appears under the final name.  Files are stored or deflated depending
+    on their type and, for files of unknown type, how well a sample of them
+    deflates.  Large files to deflate are compressed by a pool of `threads`
+    worker threads and written in the order they were added.  Given a
+    `mediastore.MediaStore`, files deflated before are copied from it as
+    they are, and files deflated now are added to it.  Files stored
+    uncompressed before are copied with the crc recorded in it.
+    """
+
+    def __init__(
+        self, path, compression=zipfile.ZIP_DEFLATED, threads=DEFAULT_THREADS,
+        store=None,
+    ):
+        self.path = path
+        self.compression = compression
+        self.store = store
+        # the number of files copied from the store, or with its crc
+        self.spliced = 0
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, self.temp_path = tempfile.mkstemp(
+            prefix='.{0}.'.format(name), suffix='.tmp', dir=directory
+        )
+        os.close(fd)
+        self.zip = zipfile.ZipFile(self.temp_path, 'w', compression)
+        self.threads = threads
+        self.pool = None
+        if compression == zipfile.ZIP_DEFLATED and threads > 1:
+            self.pool = ThreadPool(threads)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def open_entry(self, name, compress_type=None):
+        """return a file-like ZipEntry to write the content of `name` to"""
+        if compress_type is None:
+            compress_type = self.compression
+        zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = compress_type
+        return ZipEntry(self.zip, zinfo)
+
+    def write(self, path, name):
+        """add the file at path to the archive as name"""
+        compress_type = zipfile.ZIP_STORED
+        if self.compression == zipfile.ZIP_DEFLATED:
+            compress_type = choose_compress_type(path)
+        size = os.path.getsize(path)
+        if compress_type != zipfile.ZIP_DEFLATED:
+            if self.store is not None and size >= self.store.min_size:
+                self._write_stored(path, name)
+            else:
+                self.zip.write(path, name, compress_type)
+            return
+
+        digest = None
+        if self.store is not None and size >= self.store.min_size:
+            digest, blob = self.store.lookup(path)
+            if blob is not None and self._splice(path, name, blob):
+                return
+        if self.pool is not None and size >= PARALLEL_THRESHOLD:
+            result = self.pool.apply_async(deflate_file, (path,))
+            self.pending.append((path, name, digest, result))
+            # bound the number of compressed files held in memory
+            self._write_pending(limit=self.threads)
+        elif digest is not None:
+            self._write_deflated(path, name, digest, *deflate_file(path))
+        else:
+            self.zip.write(path, name, compress_type)
+
+    def infolist(self):
+        return self.zip.infolist()
+
+    def close(self):
+        self._write_pending(limit=0)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.zip.close()
+        os.chmod(self.temp_path, 0o666 & ~_UMASK)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.temp_path, self.path)
+
+    def abort(self):
+        """discard the archive, leaving any previous one in place"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        if self.zip.fp is not None:
+            self.zip.fp.close()
+            self.zip.fp = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def _write_pending(self, limit):
+        """write deflated files, waiting until no more than limit remain"""
+        while self.pending and (
+            len(self.pending) > limit or self.pending[0][3].ready()
+        ):
+            path, name, digest, result = self.pending.pop(0)
+            self._write_deflated(path, name, digest, *result.get())
+
+    def _write_deflated(self, path, name, digest, crc, size, data):
+        """write the raw deflated data of a file, storing it under digest"""
+        entry = ZipEntry(self.zip, self._file_info(path, name))
+        entry._write(data)
+        entry._finish(crc, size, len(data))
+        if digest is not None:
+            self.store.add(digest, crc, size, data)
+
+    def _splice(self, path, name, blob):
+        """copy the deflated data of a file from the store
+
+        returns False if the blob has gone, evicted by another process.
+        """
+        crc, size, compress_size, blob_path = blob
+        try:
+            fh = open(blob_path, 'rb')
+        except IOError:
+            return False
+        with fh:
+            entry = ZipEntry(self.zip, self._file_info(path, name))
+            while True:
+                data = fh.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                entry._write(data)
+            entry._finish(crc, size, compress_size)
+        self.spliced += 1
+        return True
+
+    def _write_stored(self, path, name):
+        """copy a file uncompressed, with its crc from the store if known
+
+        the crc of a file not known yet is computed while copying it and
+        added to the store.
+        """
+        stat = os.stat(path)
+        crc = self.store.lookup_crc(path, stat)
+        entry = ZipEntry(
+            self.zip, self._file_info(path, name, zipfile.ZIP_STORED, stat)
+        )
+        with open(path, 'rb') as fh:
+            while True:
+                data = fh.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                if crc is None:
+                    entry.write(data)
+                else:
+                    entry._write(data)
+        if crc is None:
+            entry.close()
+            # a file changed while it was copied is looked at again next time
+            if entry.file_size == stat.st_size:
+                self.store.add_crc(path, stat, entry.zinfo.CRC)
+        else:
+            entry._finish(crc, entry.compress_size, entry.compress_size)
+            self.spliced += 1
+
+    def _file_info(
+        self, path, name, compress_type=zipfile.ZIP_DEFLATED, stat=None,
+    ):
+        """return the ZipInfo of an entry for the file at path"""
+        if stat is None:
+            stat = os.stat(path)
+        zinfo = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+        zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = compress_type
+        return zinfo